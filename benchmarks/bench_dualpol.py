@@ -0,0 +1,423 @@
+"""
+Title/Version
+-------------
+DualPol Benchmarks
+Times each retrieval stage of dualpol.DualPolRetrieval on synthetic
+polarimetric radar volumes and records peak memory use.
+
+
+Overview
+--------
+Synthetic Py-ART radar objects with reflectivity (DZ), differential
+reflectivity (DR), correlation coefficient (RH), and differential phase (DP)
+fields are generated for several volume sizes. No data files or network
+access are needed. Each size runs in its own process, so peak RSS is
+reported per size.
+
+Results are written as JSON, and can be compared against an earlier
+results file to catch performance regressions:
+
+python benchmarks/bench_dualpol.py --sizes small medium -o new.json
+python benchmarks/bench_dualpol.py --compare old.json -o new.json
+
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import multiprocessing
+import numpy as np
+import pyart
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import dualpol
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# (rays per sweep, gates, sweeps)
+SIZES = {'small': (360, 500, 1),
+         'medium': (360, 500, 14),
+         'large': (720, 1000, 14),
+         'xlarge': (720, 2000, 14)}
+
+# (DualPolRetrieval method benchmarked, retrieval stage that runs it)
+STAGES = [('calculate_kdp', 'kdp'),
+          ('interpolate_sounding_to_radar', 'sounding'),
+          ('do_qc', 'qc'),
+          ('get_hid', 'fhc'),
+          ('get_precip_rate', 'precip'),
+          ('get_dsd', 'dsd'),
+          ('get_liquid_and_frozen_mass', 'mass')]
+
+GATE_SPACING = 150.0
+BENCH_KW = {'dz': 'DZ', 'dr': 'DR', 'rh': 'RH', 'dp': 'DP',
+            'qc_flag': True, 'gs': GATE_SPACING}
+
+if hasattr(time, 'process_time'):
+    cpu_time = time.process_time
+else:
+    cpu_time = time.clock
+
+#####################################
+
+
+def make_synthetic_radar(rays_per_sweep=360, ngates=500, nsweeps=1,
+                         seed=0):
+    """
+    Returns a Py-ART PPI radar object with realistic-looking DZ, DR, RH,
+    and DP fields: a few convective cells embedded in stratiform rain,
+    weakening with height, surrounded by masked noise.
+    """
+    rs = np.random.RandomState(seed)
+    radar = pyart.testing.make_empty_ppi_radar(ngates, rays_per_sweep,
+                                               nsweeps)
+    radar.range['data'] = GATE_SPACING * (np.arange(ngates) + 0.5)
+    elevs = np.linspace(0.5, 19.5, nsweeps)
+    radar.fixed_angle['data'] = elevs
+    radar.elevation['data'] = np.repeat(elevs, rays_per_sweep)
+    radar.azimuth['data'] = np.tile(
+        np.arange(rays_per_sweep) * 360.0 / rays_per_sweep, nsweeps)
+    rng = radar.range['data'][np.newaxis, :] / 1000.0
+    az = np.deg2rad(radar.azimuth['data'])[:, np.newaxis]
+    el = np.deg2rad(radar.elevation['data'])[:, np.newaxis]
+    x = rng * np.cos(el) * np.sin(az)
+    y = rng * np.cos(el) * np.cos(az)
+    hgt = rng * np.sin(el) + rng**2 / (2 * 8494.7)
+    max_rng = rng.max()
+    dz = 25.0 * np.exp(-((rng - 0.4 * max_rng) / (0.3 * max_rng))**2)
+    for _ in range(6):
+        x0, y0 = rs.uniform(-0.7, 0.7, 2) * max_rng
+        radius = rs.uniform(3, 12)
+        peak = rs.uniform(30, 35)
+        dz = dz + peak * np.exp(-((x - x0)**2 + (y - y0)**2) / radius**2)
+    dz = dz - 3.0 * np.maximum(hgt - 5.0, 0) + rs.normal(0, 1.5, dz.shape)
+    dr = np.clip(0.06 * (dz - 20.0), -0.3, 4.0) + rs.normal(0, 0.2, dz.shape)
+    rh = np.clip(0.99 - 0.002 * np.maximum(dz - 45, 0) +
+                 rs.normal(0, 0.005, dz.shape), 0.7, 1.0)
+    kdp = np.where(dz > 35, 10**((dz - 55.0) / 15.0), 0.0)
+    dp = 30.0 + 2.0 * np.cumsum(kdp, axis=1) * GATE_SPACING / 1000.0 + \
+        rs.normal(0, 2.0, dz.shape)
+    noise = dz < 0
+    rh[noise] = rs.uniform(0.3, 0.9, noise.sum())
+    dp[noise] = rs.uniform(-180, 180, noise.sum())
+    for name, data, units in zip(['DZ', 'DR', 'RH', 'DP'], [dz, dr, rh, dp],
+                                 ['dBZ', 'dB', '', 'deg']):
+        radar.add_field(name, {'data': np.ma.masked_array(
+                               data, mask=noise.copy()),
+                               'units': units, '_FillValue': dualpol.BAD},
+                        replace_existing=True)
+    return radar
+
+
+def make_synthetic_sounding(nonlinear=False):
+    """
+    Returns a dict sounding: 30 C at the surface, 6.5 C/km lapse rate. With
+    nonlinear=True, the lapse rate varies with height, so the freezing level
+    found from part of the volume differs from that of the whole volume.
+    """
+    z = np.arange(0, 20000.0, 250.0)
+    T = 30.0 - 6.5 * z / 1000.0
+    if nonlinear:
+        T -= 3.0 * np.sin(np.pi * z / 4000.0)
+    T = np.maximum(T, -56.5)
+    return {'z': np.ma.masked_array(z, mask=False),
+            'T': np.ma.masked_array(T, mask=False)}
+
+
+def bench_size(size, repeat=1, fused=False, hid=False, sweeps=False):
+    """
+    Times each stage on a synthetic volume of the given size, taking the
+    fastest of repeat runs, then measures each stage's peak traced memory
+    in a separate (untimed) pass. Returns a results dict.
+    """
+    rays, ngates, nsweeps = SIZES[size]
+    kwargs = dict(BENCH_KW, sounding=make_synthetic_sounding())
+    stages = dict([(name, {'wall': None, 'cpu': None, 'peak_bytes': None})
+                   for name, _ in STAGES])
+    total = None
+    for _ in range(repeat):
+        radar = make_synthetic_radar(rays, ngates, nsweeps)
+        retrieve = dualpol.DualPolRetrieval(radar, lazy=True, **kwargs)
+        for name, stage in STAGES:
+            wall, cpu = time.time(), cpu_time()
+            retrieve.run_stage(stage)
+            wall, cpu = time.time() - wall, cpu_time() - cpu
+            if stages[name]['wall'] is None or wall < stages[name]['wall']:
+                stages[name]['wall'] = wall
+                stages[name]['cpu'] = cpu
+        radar = make_synthetic_radar(rays, ngates, nsweeps)
+        wall = time.time()
+        dualpol.DualPolRetrieval(radar, **kwargs)
+        wall = time.time() - wall
+        total = wall if total is None else min(total, wall)
+    if tracemalloc is not None:
+        radar = make_synthetic_radar(rays, ngates, nsweeps)
+        retrieve = dualpol.DualPolRetrieval(radar, lazy=True, **kwargs)
+        tracemalloc.start()
+        for name, stage in STAGES:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.stop()
+                tracemalloc.start()
+            base = tracemalloc.get_traced_memory()[0]
+            retrieve.run_stage(stage)
+            stages[name]['peak_bytes'] = \
+                tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+    result = {'size': size, 'rays': rays * nsweeps, 'gates': ngates,
+              'sweeps': nsweeps, 'total_wall': total, 'stages': stages,
+              'peak_rss_bytes': None}
+    if fused:
+        result['fused'] = check_fused(size, repeat=repeat)
+    if hid:
+        result['hid'] = check_hid(size, repeat=repeat)
+    if sweeps:
+        result['sweep_workers'] = check_sweeps(size, repeat=repeat)
+    if resource is not None:
+        scale = 1 if sys.platform == 'darwin' else 1024
+        result['peak_rss_bytes'] = \
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    return result
+
+
+def check_fused(size, repeat=1):
+    """
+    Runs the rain, DSD, and mass stages separately and with fused=True on
+    the same synthetic volume, with a linear and then a nonlinear sounding
+    (on at least 4 sweeps, so that blocks of rays span different heights).
+    Returns the fastest total time of those stages in each mode (linear
+    sounding), and the largest absolute difference in each product for each
+    sounding. Raises AssertionError if the products differ.
+    """
+    rays, ngates, nsweeps = SIZES[size]
+    walls = {}
+    diffs = {}
+    for sounding in ['linear', 'nonlinear']:
+        kwargs = dict(BENCH_KW, instrument=True,
+                      sounding=make_synthetic_sounding(
+                          nonlinear=sounding == 'nonlinear'))
+        fields = {}
+        sweeps = nsweeps if sounding == 'linear' else max(nsweeps, 4)
+        for fused in [False, True]:
+            for _ in range(repeat if sounding == 'linear' else 1):
+                radar = make_synthetic_radar(rays, ngates, sweeps)
+                retrieve = dualpol.DualPolRetrieval(radar, fused=fused,
+                                                    **kwargs)
+                wall = sum([rec.wall for rec in retrieve.stage_timing
+                            if rec.stage in ['precip', 'dsd', 'mass']])
+                if sounding == 'linear':
+                    walls[fused] = min(wall, walls.get(fused, wall))
+            fields[fused] = retrieve.radar.fields
+        diffs[sounding] = {}
+        for name in ['rain', 'method', 'D0', 'NW', 'MU', 'MW', 'MI']:
+            a, b = fields[False][name]['data'], fields[True][name]['data']
+            same_mask = np.array_equal(np.ma.getmaskarray(a),
+                                       np.ma.getmaskarray(b))
+            diff = np.abs(np.ma.getdata(a).astype(float) -
+                          np.ma.getdata(b).astype(float))
+            diffs[sounding][name] = float(np.nanmax(diff)) if same_mask \
+                else None
+            assert diffs[sounding][name] == 0.0, \
+                'Fused %s differs (%s sounding): %s' % (
+                    name, sounding, diffs[sounding][name])
+    return {'separate_wall': walls[False], 'fused_wall': walls[True],
+            'max_abs_diff': diffs}
+
+
+def check_hid(size, repeat=1, block_size=65536):
+    """
+    Runs the HID stage on the whole volume at once and in blocks of
+    block_size gates (fhc_block_size) on the same synthetic volume. Returns
+    the fastest time and the peak traced memory of the stage in each mode,
+    and whether the HID fields are identical.
+    """
+    rays, ngates, nsweeps = SIZES[size]
+    kwargs = dict(BENCH_KW, sounding=make_synthetic_sounding(), lazy=True)
+    result = {}
+    fields = {}
+    for mode, blocks in [('full', None), ('blocks', block_size)]:
+        wall = None
+        for _ in range(repeat):
+            radar = make_synthetic_radar(rays, ngates, nsweeps)
+            retrieve = dualpol.DualPolRetrieval(
+                radar, fhc_block_size=blocks, **kwargs)
+            for stage in retrieve.stage_dependencies('fhc'):
+                retrieve.run_stage(stage)
+            start = time.time()
+            retrieve.run_stage('fhc')
+            elapsed = time.time() - start
+            wall = elapsed if wall is None else min(wall, elapsed)
+        fields[mode] = retrieve.radar.fields['FH']['data']
+        peak = None
+        if tracemalloc is not None:
+            radar = make_synthetic_radar(rays, ngates, nsweeps)
+            retrieve = dualpol.DualPolRetrieval(
+                radar, fhc_block_size=blocks, **kwargs)
+            for stage in retrieve.stage_dependencies('fhc'):
+                retrieve.run_stage(stage)
+            tracemalloc.start()
+            base = tracemalloc.get_traced_memory()[0]
+            retrieve.run_stage('fhc')
+            peak = tracemalloc.get_traced_memory()[1] - base
+            tracemalloc.stop()
+        result[mode + '_wall'] = wall
+        result[mode + '_peak_bytes'] = peak
+    result['identical'] = bool(np.ma.allequal(fields['full'],
+                                              fields['blocks']))
+    return result
+
+
+def check_sweeps(size, repeat=1, workers=2):
+    """
+    Runs the whole retrieval serially and with sweep_workers thread (and,
+    outside daemon processes, process) pools on the same synthetic volume
+    (at least 4 sweeps) with a nonlinear sounding that crosses 0 C. Returns
+    the fastest time in each mode and the largest absolute difference from
+    serial mode in each product. Raises AssertionError if products differ.
+    """
+    rays, ngates, nsweeps = SIZES[size]
+    nsweeps = max(nsweeps, 4)
+    kwargs = dict(BENCH_KW, sounding=make_synthetic_sounding(nonlinear=True))
+    modes = [('serial', None, 'thread'), ('thread', workers, 'thread')]
+    if not multiprocessing.current_process().daemon:
+        modes.append(('process', workers, 'process'))
+    result = {}
+    fields = {}
+    for mode, nworkers, pool in modes:
+        wall = None
+        for _ in range(repeat):
+            radar = make_synthetic_radar(rays, ngates, nsweeps)
+            start = time.time()
+            retrieve = dualpol.DualPolRetrieval(
+                radar, sweep_workers=nworkers, sweep_pool=pool, **kwargs)
+            elapsed = time.time() - start
+            wall = elapsed if wall is None else min(wall, elapsed)
+        result[mode + '_wall'] = wall
+        fields[mode] = retrieve.radar.fields
+    diffs = {}
+    for mode in fields:
+        if mode == 'serial':
+            continue
+        diffs[mode] = {}
+        for name in ['FH', 'rain', 'method', 'D0', 'NW', 'MU', 'MW', 'MI']:
+            a, b = fields['serial'][name]['data'], fields[mode][name]['data']
+            same_mask = np.array_equal(np.ma.getmaskarray(a),
+                                       np.ma.getmaskarray(b))
+            diff = np.abs(np.ma.getdata(a).astype(float) -
+                          np.ma.getdata(b).astype(float))
+            diffs[mode][name] = float(np.nanmax(diff)) if same_mask else None
+            assert diffs[mode][name] == 0.0, \
+                'Sweep-parallel (%s) %s differs: %s' % (
+                    mode, name, diffs[mode][name])
+    result['max_abs_diff'] = diffs
+    return result
+
+
+def _bench_size_in_child(args):
+    return bench_size(*args)
+
+
+def run_benchmarks(sizes, repeat=1, fused=False, hid=False, sweeps=False):
+    """
+    Benchmarks each size in a fresh process. Returns a JSON-ready dict of
+    results plus environment information.
+    """
+    results = []
+    for size in sizes:
+        pool = multiprocessing.Pool(1)
+        try:
+            results.append(pool.apply(_bench_size_in_child,
+                                      ((size, repeat, fused, hid, sweeps),)))
+        finally:
+            pool.close()
+            pool.join()
+    return {'dualpol_version': dualpol.VERSION,
+            'numpy_version': np.__version__,
+            'python_version': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results}
+
+
+def compare_results(new, old, threshold=1.25, min_time=0.01):
+    """
+    Returns a list of text descriptions of stages (or totals) that got
+    slower than threshold times their time in the old results. Stages
+    faster than min_time seconds are ignored as noise.
+    """
+    old_by_size = dict([(res['size'], res) for res in old['results']])
+    regressions = []
+    for res in new['results']:
+        if res['size'] not in old_by_size:
+            continue
+        prev = old_by_size[res['size']]
+        pairs = [('total', res['total_wall'], prev['total_wall'])]
+        for name in res['stages']:
+            if name in prev['stages']:
+                pairs.append((name, res['stages'][name]['wall'],
+                              prev['stages'][name]['wall']))
+        for name, now, before in pairs:
+            if before is not None and now is not None and \
+               before >= min_time and now > threshold * before:
+                regressions.append('%s %s: %.3f s -> %.3f s' %
+                                   (res['size'], name, before, now))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark DualPol retrieval stages on synthetic data.')
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'],
+                        choices=sorted(SIZES), help='Volume sizes to run')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs per size (fastest is kept)')
+    parser.add_argument('--fused', action='store_true',
+                        help='Also compare fused rain/DSD/mass with the '
+                        'separate stages (time and max difference)')
+    parser.add_argument('--hid', action='store_true',
+                        help='Also compare whole-volume and blocked HID '
+                        '(time and peak memory)')
+    parser.add_argument('--sweeps', action='store_true',
+                        help='Also compare serial and sweep-parallel '
+                        'retrievals (time and max difference)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='JSON results file (default stdout)')
+    parser.add_argument('--compare', default=None,
+                        help='Earlier JSON results to check for regressions')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='Slowdown ratio reported as a regression')
+    args = parser.parse_args(argv)
+    results = run_benchmarks(args.sizes, repeat=args.repeat,
+                             fused=args.fused, hid=args.hid,
+                             sweeps=args.sweeps)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old = json.load(f)
+        regressions = compare_results(results, old, threshold=args.threshold)
+        for line in regressions:
+            print('REGRESSION', line, file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""
+Title/Version
+-------------
+DualPol Import Benchmark
+Measures how long "import dualpol" takes in a fresh interpreter and checks
+that no heavy dependency is imported along with it.
+
+
+Overview
+--------
+Heavy dependencies (Py-ART, matplotlib, SkewT, SciPy, CSU_RadarTools) are
+supposed to load only when the features that need them are first used.
+This script imports dualpol in new Python processes, reports the fastest
+import time and any heavy modules that were loaded, as JSON, and exits
+with status 1 if a heavy module was loaded or the import took longer than
+--max-seconds.
+
+python benchmarks/bench_import.py --repeat 5 --max-seconds 0.5
+
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+HEAVY = ['pyart', 'matplotlib', 'skewt', 'scipy', 'csu_radartools']
+
+SCRIPT = """
+import sys, time, json
+sys.path.insert(0, %r)
+start = time.time()
+import dualpol
+elapsed = time.time() - start
+heavy = sorted(set([m.split('.')[0] for m in sys.modules]) & set(%r))
+print(json.dumps({'seconds': elapsed, 'heavy_modules': heavy}))
+"""
+
+
+def time_import(repeat=5):
+    """
+    Imports dualpol in repeat fresh interpreters. Returns a dict with the
+    fastest import time (s), all times, and heavy modules loaded.
+    """
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir)
+    times = []
+    heavy = set()
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c', SCRIPT % (os.path.abspath(root), HEAVY)])
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        times.append(result['seconds'])
+        heavy.update(result['heavy_modules'])
+    return {'seconds': min(times), 'all_seconds': times,
+            'heavy_modules': sorted(heavy), 'python': sys.version.split()[0]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the time taken by "import dualpol".')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Fresh interpreters to time (fastest is kept)')
+    parser.add_argument('--max-seconds', type=float, default=None,
+                        help='Fail if the import takes longer than this')
+    args = parser.parse_args(argv)
+    result = time_import(repeat=args.repeat)
+    print(json.dumps(result, indent=2, sort_keys=True))
+    if result['heavy_modules']:
+        print('Heavy modules imported with dualpol:',
+              ', '.join(result['heavy_modules']), file=sys.stderr)
+        return 1
+    if args.max_seconds is not None and result['seconds'] > args.max_seconds:
+        print('Import took %.3f s' % result['seconds'], file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
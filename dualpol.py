@@ -2,9 +2,9 @@
 Title/Version
 -------------
 Python Interface to Dual-Pol Radar Algorithms (DualPol)
-DualPol v0.9
+DualPol v1.0
 Developed & tested with Python 2.7 and 3.4
-Last changed 09/02/2015
+Last changed 10/16/2026
 
 
 Author
@@ -30,12 +30,88 @@ import dualpol
 
 Notes
 -----
-Dependencies: numpy, pyart, warnings, skewt, csu_radartools, matplotlib
+Dependencies: numpy, pyart, warnings, skewt, csu_radartools, matplotlib, scipy
+Only numpy and the standard library are imported with dualpol; the others
+are imported when the features that need them are first used.
 Python 3 compliant SkewT here: https://github.com/tjlang/SkewT
 
 
 Change Log
 ----------
+v1.0 Major Changes (10/16/26):
+1. Added batch_retrieval() and a command-line interface (python dualpol.py)
+   for processing whole archives of radar volumes with a process pool.
+2. New sweep_workers and sweep_pool keywords split a volume by sweep and run
+   each sweep's retrievals in parallel, with speedup reported in
+   DualPolRetrieval.sweep_timing.
+3. New GeometryCache class (geometry_cache keyword) reuses gate heights and
+   sounding-interpolated temperatures across volumes that share a scan
+   geometry, with LRU eviction and an optional on-disk .npy store.
+4. New block_size keyword streams very large volumes through the retrieval
+   chain in blocks of rays, bounding peak memory by the block size.
+5. New lazy keyword computes each product only when it is first accessed,
+   resolving dependencies between retrieval stages automatically.
+6. New output_precision keyword stores products in compact dtypes (uint8 for
+   HID/rainfall method, float32 otherwise) with optional int16 packing on
+   output.
+7. New VolumeMask class (DualPolRetrieval.volume_mask) holds one mask array
+   referenced by reflectivity and every retrieved field, instead of each
+   field owning a copy. QC and later updates (e.g., clutter) are applied to
+   it in place, so KDP/FDP/SDP masks now also reflect QC.
+8. Sounding ingest reworked: vectorized monotonic filtering, parsed sounding
+   files cached by path and modification time, new Sounding objects that
+   can be shared across volumes/workers, and interpolation between two
+   soundings bracketing the scan time (read_sounding, interpolate_soundings).
+9. New instrument keyword and Instrumentation class record wall time, CPU
+   time, and memory growth for each retrieval stage, reported in
+   DualPolRetrieval.stage_timing and passed to callbacks or a logger.
+10. New DualPolRetrieval.reconfigure() method changes keywords on an
+    existing retrieval and recomputes only the stages they affect.
+11. New RainAccumulator class time-integrates rain rates from successive
+    volumes into running or period (e.g., hourly) totals on a fixed polar
+    or Cartesian grid, with checkpointing to disk.
+12. New GridMapper class (grid keyword) maps retrieved products to a
+    Cartesian grid with a sparse weight matrix that is built once per scan
+    geometry and cached. Results are in DualPolRetrieval.grids.
+13. New ProductStore class writes retrieved products from many volumes into
+    memory-mapped .npy files with a JSON index, so one field or sweep can be
+    read back without loading the rest.
+14. New KdpCache class (kdp_cache keyword) stores KDP/FDP/SDP on disk, keyed
+    by a hash of the input data and KDP settings, and shared safely between
+    processes with LRU eviction by total size.
+15. KDP algorithms are now backends registered by name for the kdp_method
+    keyword (register_kdp_backend), and the new kdp_workers keyword splits
+    rays among a process or thread pool. Throughput is reported in
+    DualPolRetrieval.kdp_timing. The kdp_window keyword is now passed on to
+    the CSU KDP calculation.
+16. New fused keyword computes rain, DSD, and mass products in one pass over
+    blocks of rays, writing into preallocated outputs.
+17. New WatchService class (python dualpol.py DIR --watch) retrieves radar
+    files as they arrive in a directory, with a bounded, warm worker pool,
+    latency metrics, and a choice of queueing or skipping under backlog.
+18. Py-ART, matplotlib, SkewT, SciPy, and CSU_RadarTools modules are now
+    imported on first use rather than with dualpol, for fast startup.
+19. New sweeps, range_limits, and azimuth_limits keywords restrict all
+    retrievals to a subset of the volume, returned in the full radar object
+    or a trimmed one (subset_output).
+20. New RadarNetwork class retrieves volumes from many radars in one shared
+    worker pool with per-site caches, soundings, and fair (priority-weighted)
+    scheduling, merging products into a tiled multi-radar Mosaic that is
+    updated only where each new volume has coverage.
+21. New fhc_block_size keyword evaluates HID scores in blocks of rays,
+    reducing each block with a running maximum over classes (hid_argmax), so
+    memory no longer scales with classes x volume. New fhc_confidence keyword
+    adds the top-two score margin as a compact FH_CONF field.
+22. New ResultCache class (result_cache keyword) stores finished retrievals
+    on disk, keyed by the input fields, scan, and effective keywords, so a
+    volume retrieved again with the same settings just reloads its products.
+23. New RetrievalConfig class validates keywords once into a frozen,
+    hashable config that compiles to a reusable ExecutionPlan (stage list,
+    input and output fields), passed to DualPolRetrieval as plan.
+24. New BufferPool class (buffer_pool keyword) keeps product arrays, keyed
+    by shape and dtype, for reuse by later volumes once
+    DualPolRetrieval.release() is called, and reports occupancy and reuse.
+
 v0.9 Major Changes (09/02/15):
 1. Added QC capabilities, including filters for insects, high SDP, and speckles.
    These are based on the csu_radartools.csu_misc module. QC is performed prior
@@ -73,22 +149,84 @@ v0.1 Functionality(01/26/15):
 
 """
 from __future__ import print_function
+import os
+import sys
+import glob
+import json
+import time
+import datetime
+import traceback
+import copy
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import hashlib
+import threading
+import weakref
+from collections import namedtuple, deque, OrderedDict
+import importlib
+import inspect
+import numbers
 import numpy as np
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
 import warnings
-import pyart
-import matplotlib.colors as colors
-from pyart.io.common import radar_coords_to_cart
-from skewt import SkewT
-from csu_radartools import (csu_fhc, csu_liquid_ice_mass, csu_blended_rain,
-                            csu_dsd, csu_kdp, csu_misc)
-
-VERSION = '0.9'
+
+
+class _LazyModule(object):
+
+    """
+    Stands in for a module (or a submodule attribute of a package, as in
+    "from package import name"), importing it on first attribute access.
+    """
+
+    def __init__(self, name, attr=None):
+        self._name = name
+        self._attr = attr
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            if self._attr is not None:
+                try:
+                    module = getattr(module, self._attr)
+                except AttributeError:
+                    module = importlib.import_module(
+                        self._name + '.' + self._attr)
+            self._module = module
+        return getattr(self._module, attr)
+
+
+# Heavy dependencies load when the features that need them are first used
+pyart = _LazyModule('pyart')
+colors = _LazyModule('matplotlib.colors')
+SkewT = _LazyModule('skewt', 'SkewT')
+sparse = _LazyModule('scipy.sparse')
+spatial = _LazyModule('scipy.spatial')
+csu_fhc = _LazyModule('csu_radartools', 'csu_fhc')
+csu_liquid_ice_mass = _LazyModule('csu_radartools', 'csu_liquid_ice_mass')
+csu_blended_rain = _LazyModule('csu_radartools', 'csu_blended_rain')
+csu_dsd = _LazyModule('csu_radartools', 'csu_dsd')
+csu_kdp = _LazyModule('csu_radartools', 'csu_kdp')
+csu_misc = _LazyModule('csu_radartools', 'csu_misc')
+
+VERSION = '1.0'
 RNG_MULT = 1000.0
-DEFAULT_WEIGHTS = csu_fhc.DEFAULT_WEIGHTS
+# Same as csu_fhc.DEFAULT_WEIGHTS and csu_misc.DEFAULT_DZ_RANGE/_DR_THRESH
+DEFAULT_WEIGHTS = {'DZ': 1.5, 'DR': 0.8, 'KD': 1.0, 'RH': 0.8, 'LD': 0.5,
+                   'T': 0.4}
 BAD = -32768
 DEFAULT_SDP = 12.0
-DEFAULT_DZ_RANGE = csu_misc.DEFAULT_DZ_RANGE
-DEFAULT_DR_THRESH = csu_misc.DEFAULT_DR_THRESH
+DEFAULT_DZ_RANGE = [[-100, 10], [10, 15], [15, 20], [20, 25], [25, 30],
+                    [30, 35]]
+DEFAULT_DR_THRESH = [1, 1.3, 1.7, 2.1, 2.5, 2.8]
 
 #####################################
 
@@ -102,9 +240,68 @@ DEFAULT_KW = {'dz': 'DZ', 'dr': 'DR', 'dp': None, 'rh': 'RH',
               'liquid_ice_flag': True, 'winter': False, 'gs': 150.0,
               'qc_flag': False, 'kdp_window': 3.0,
               'dz_range': DEFAULT_DZ_RANGE, 'name_sdp': 'SDP_CSU',
-              'thresh_dr': DEFAULT_DR_THRESH, 'speckle': 4}
+              'thresh_dr': DEFAULT_DR_THRESH, 'speckle': 4,
+              'sweep_workers': None, 'sweep_pool': 'thread',
+              'geometry_cache': None, 'block_size': None, 'lazy': False,
+              'output_precision': 'native', 'instrument': None,
+              'grid': None, 'grid_fields': None, 'kdp_cache': None,
+              'kdp_workers': None, 'kdp_pool': 'process',
+              'kdp_chunk_size': None, 'fused': False,
+              'fused_block_size': 65536, 'sweeps': None,
+              'range_limits': None, 'azimuth_limits': None,
+              'subset_output': 'full', 'fhc_block_size': None,
+              'fhc_confidence': False, 'result_cache': None,
+              'buffer_pool': None, 'freezing_level': None}
+
+# Retrieval stages in the order they run, and the keywords that switch
+# stages on when products are computed up front (lazy=False)
+STAGE_ORDER = ['kdp', 'sounding', 'qc', 'fhc', 'precip', 'dsd', 'mass',
+               'grid']
+STAGE_FLAGS = {'qc': 'qc_flag', 'fhc': 'fhc_flag', 'precip': 'precip_flag',
+               'dsd': 'dsd_flag', 'mass': 'liquid_ice_flag', 'grid': 'grid'}
+
+# Keywords that DualPolRetrieval.reconfigure() accepts, and the stages each
+# one directly affects (stages depending on those are redone as well)
+RECONFIGURE_STAGES = {'thresh_sdp': ['kdp', 'qc'], 'gs': ['kdp'],
+                      'kdp_window': ['kdp'], 'sounding': ['sounding'],
+                      'use_temp': ['sounding', 'fhc'], 'qc_flag': ['qc'],
+                      'dz_range': ['qc'], 'thresh_dr': ['qc'],
+                      'speckle': ['qc'], 'fhc_weights': ['fhc'],
+                      'fhc_T_factor': ['fhc'], 'fhc_method': ['fhc'],
+                      'winter': ['fhc'], 'band': ['fhc', 'dsd'],
+                      'rain_method': ['precip'], 'ice_flag': ['precip'],
+                      'output_precision': ['kdp', 'fhc', 'precip', 'dsd',
+                                           'mass'],
+                      'fhc_flag': [], 'precip_flag': [], 'dsd_flag': [],
+                      'liquid_ice_flag': [], 'verbose': [],
+                      'grid': ['grid'], 'grid_fields': ['grid'],
+                      'kdp_workers': [], 'kdp_pool': [],
+                      'kdp_chunk_size': [], 'fused': [],
+                      'fused_block_size': [], 'fhc_block_size': [],
+                      'fhc_confidence': ['fhc'], 'freezing_level': ['mass']}
+
+# Output precision: categorical products are stored as uint8 by the
+# 'compact'/'packed' policies; 'packed' also writes these continuous
+# products to file as int16 with (scale_factor, add_offset)
+CATEGORICAL_PRODUCTS = ['FH', 'method']
+
+# (units, long/standard name) of products from the precip, dsd, mass stages
+PRODUCT_ATTRS = {'rain': ('mm h-1', 'Rainfall Rate'),
+                 'method': ('', 'Rainfall Method'),
+                 'ZDP': ('dB', 'Difference Reflectivity'),
+                 'FI': ('', 'Ice Fraction'),
+                 'D0': ('mm', 'Median Volume Diameter'),
+                 'NW': ('mm-1 m-3', 'Normalized Intercept Parameter'),
+                 'MU': (' ', 'Mu'),
+                 'MW': ('g m-3', 'Liquid Water Mass'),
+                 'MI': ('g m-3', 'Ice Water Mass'),
+                 'FH_CONF': ('percent', 'Hydrometeor ID Confidence')}
+PACKED_SCALES = {'rain': (0.02, 0.0), 'D0': (0.001, 0.0), 'MU': (0.001, 0.0),
+                 'MW': (0.001, 0.0), 'MI': (0.001, 0.0), 'KDP': (0.002, 0.0),
+                 'FDP': (0.05, 0.0), 'SDP': (0.01, 0.0), 'ZDP': (0.01, 0.0),
+                 'FI': (0.0001, 0.0)}
 
-kwargs = np.copy(DEFAULT_KW)
+kwargs = dict(DEFAULT_KW)
 
 #####################################
 
@@ -120,9 +317,15 @@ class DualPolRetrieval(object):
     Main attributes of interest is radar, which is the original Py-ART radar
     object provided to DualPolRetrieval. DualPolRetrieval.radar contains
     new fields based on what the user wanted DualPolRetrieval to do.
+    DualPolRetrieval.success is True once all requested retrievals have run.
+    DualPolRetrieval.volume_mask is a VolumeMask whose mask array is shared
+    (not copied) by the reflectivity field and every new field. Use its
+    add() method to mask more gates (e.g., clutter) in all fields at once,
+    and unshare_mask() on a field's data before masking gates in it alone.
 
     New fields that can be in DualPolRetrieval.radar.fields:
     'FH' (or whatever user provided in name_fhc kwarg) = HID
+    'FH_CONF' = HID confidence (top-two score margin, if fhc_confidence)
     'FI' = Ice Fraction
     'ZDP' = Difference Reflectivity
     'KDP_CSU' = KDP as calculated by CSU_RadarTools
@@ -152,9 +355,13 @@ class DualPolRetrieval(object):
         rh = String name of correlation coefficient field
         ld = String name of linear depolarization ratio field
         dp = String name of differential phase field
-        sounding = Name of UWYO sounding file or 2xN array where:
-                   sounding['z'] = Heights (km MSL), must be montonic
+        sounding = Name of UWYO sounding file (parsed files are cached), a
+                   Sounding object (see read_sounding), a SkewT Sounding
+                   object, or 2xN array where:
+                   sounding['z'] = Heights (m MSL), must be montonic
                    sounding['T'] = Temperatures (C)
+                   Can also be a pair of Sounding objects with times that
+                   bracket the scan, which are interpolated to the scan time.
         winter = Flag to note whether to use wintertime retrievals
         band = Radar frequency band letter ('C' or 'S' supported)
         verbose = Set to True to get text feedback
@@ -165,7 +372,8 @@ class DualPolRetrieval(object):
             {'DZ': 1.5, 'DR': 0.8, 'KD': 1.0, 'RH': 0.8, 'LD': 0.5, 'T': 0.4}
         name_fhc = Name to give HID field once calculated
         fhc_method = 'hybrid' or 'linear' methods; hybrid preferred
-        kdp_method = 'CSU' currently supported
+        kdp_method = 'CSU' by default, or any name registered with
+                     register_kdp_backend()
         bad = Value to provide bad data
         use_temp = Set to False to not consider T in HID calculations
         rain_method = Method to use to estimate rainfall. If not 'hidro', then
@@ -186,7 +394,7 @@ class DualPolRetrieval(object):
         qc_flag = Set to true to filter the data for insects, high SDP
                   (set by thresh_sdp keyword), and speckles. Will permanently
                   change the reflectivity field's mask, and by extension affect
-                  all retrieved fields' masks.
+                  all retrieved fields' masks (via the shared volume mask).
         dz_range = Used by the insect filter. A list of 2-element tuples.
                    Within each DZ range represented by a tuple, the ZDR
                    threshold in dr_thresh (see below) will be applied.
@@ -194,13 +402,136 @@ class DualPolRetrieval(object):
                     element of dz_range (see above).
         speckle = Number of contiguous gates or less for an element to be
                   considered a speckle.
+        sweep_workers = Set to a number of workers to split the volume by
+                        sweep (or by block_size rays, if set) and run each
+                        block's retrievals in parallel.
+                        Results are identical to processing the whole volume
+                        at once (the default, None). radar_z and radar_T are
+                        not kept in this mode. Timing info is stored in
+                        DualPolRetrieval.sweep_timing, with speedup the
+                        blocks' total CPU time over the elapsed time.
+        sweep_pool = 'thread' or 'process' pool to use with sweep_workers.
+        block_size = Set to a number of rays to stream the volume through the
+                     whole retrieval chain that many rays at a time, writing
+                     into preallocated output fields. Peak memory then scales
+                     with block size rather than volume size. Combine with
+                     sweep_workers to process blocks in parallel. Results are
+                     identical to the default (None) whole-volume mode.
+        lazy = Set to True to skip computing products up front. Each product
+               (HID, rain/method, D0/NW/MU, MW/MI, KDP/FDP/SDP, ZDP/FI) is
+               then computed, along with whatever it depends on, the first
+               time it is looked up in radar.fields (or via get_product()),
+               and kept for later use. The *_flag keywords are ignored.
+               Ignored with sweep_workers or block_size, which compute the
+               products up front.
+        output_precision = Storage policy for retrieved fields. 'native' keeps
+                           the dtypes returned by CSU_RadarTools (int64,
+                           float64). 'compact' stores FH and method as uint8
+                           and all other products as float32. 'packed' is
+                           'compact' plus scale_factor/add_offset attributes
+                           so Py-ART writes continuous products (except NW)
+                           to file as int16; gates that can't be packed are
+                           masked. A dict of {product: dtype} sets dtypes
+                           individually, where products are 'FH', 'method',
+                           'rain', 'D0', 'NW', 'MU', 'MW', 'MI', 'KDP', 'FDP',
+                           'SDP', 'ZDP', and 'FI'.
+        geometry_cache = GeometryCache object used to reuse gate heights and
+                         temperatures between volumes with the same scan
+                         geometry. Set to True to use the module-level
+                         GEOMETRY_CACHE (each worker process gets its own
+                         when used with batch_retrieval).
+        instrument = Set to True, an Instrumentation object, or a callable to
+                     record wall time, CPU time, and memory growth of each
+                     retrieval stage in DualPolRetrieval.stage_timing (see
+                     timing_report()). A callable is called with each
+                     StageRecord as it is made. None (default) is off.
+        grid = GridMapper object used to map products to a Cartesian grid,
+               stored as masked arrays in DualPolRetrieval.grids.
+        grid_fields = List of fields to grid. Default is whichever of HID,
+                      rain, D0, MW, and MI are retrieved.
+        kdp_cache = KdpCache object (or directory name for one) used to reuse
+                    KDP/FDP/SDP calculated before from the same data and
+                    settings, by this or other processes.
+        kdp_workers = Set to a number of workers to split the rays among when
+                      calculating KDP. Timing (rays/s) is stored in
+                      DualPolRetrieval.kdp_timing.
+        kdp_pool = 'process' (default) or 'thread' pool for kdp_workers.
+                   Threads only help with backends that release the GIL.
+        kdp_chunk_size = Rays per task for kdp_workers, default splits rays
+                         into 4 tasks per worker.
+        fused = Set to True to compute the rain, DSD, and mass products that
+                are due together, in one pass over blocks of whole rays
+                (see get_fused_products), instead of one full-volume pass
+                each. Results are identical.
+        fused_block_size = Approximate number of gates per block for fused.
+        sweeps = List of sweep numbers to retrieve (e.g., [0] for the lowest)
+        range_limits = (min, max) range (m) of the gates to retrieve
+        azimuth_limits = (start, end) azimuths (deg) of the sector to
+                         retrieve, clockwise, e.g. (300, 60) crosses north.
+                         With any of sweeps, range_limits, or azimuth_limits
+                         set, all retrievals run on just that subset, so cost
+                         scales with its size, except that KDP is filtered
+                         along the full range of the selected rays. With
+                         qc_flag, despeckling may mask extra gates within
+                         speckle gates of the range limits.
+        subset_output = 'full' (default) to put the retrieved fields back in
+                        the full radar object, masked outside the subset
+                        (reflectivity then keeps its own mask), or 'trim' to
+                        leave DualPolRetrieval.radar as a radar object holding
+                        just the subset. lazy=True always trims.
+        fhc_block_size = Approximate number of gates per block of rays for
+                         HID. Class scores are reduced to the HID (see
+                         hid_argmax) one block at a time, so only one
+                         block's scores for every class are held at once
+                         instead of the whole volume's. Default (None) is
+                         one block. Results are identical.
+        fhc_confidence = Set to True to also add FH_CONF, the margin between
+                         the top two HID scores (percent, uint8).
+        result_cache = ResultCache object (or directory name for one). A
+                       volume retrieved before from the same input fields,
+                       scan, and keywords gets its products from the cache
+                       instead of being retrieved again. Ignored if lazy.
+        freezing_level = Height (km MSL) of the freezing level used by the
+                         liquid/ice mass retrieval. Default (None) finds it
+                         from the sounding at the gates of the whole volume.
+        buffer_pool = BufferPool object (or True for dualpol.BUFFER_POOL, one
+                      per process) that products are stored in. Call
+                      release() when done with the retrieval to return them.
+        plan = RetrievalConfig or ExecutionPlan (see RetrievalConfig) giving
+               all of the above at once. Other keywords given with it are
+               applied on top (making a new config for this volume).
         """
         # Set radar fields
-        kwargs = check_kwargs(kwargs, DEFAULT_KW)
+        self.success = False
+        self.errors = []
+        self.plan = kwargs.pop('plan', None)
+        if self.plan is not None:
+            if isinstance(self.plan, RetrievalConfig):
+                self.plan = self.plan.compile()
+            if kwargs:  # Per-volume changes (e.g., a site's sounding)
+                self.plan = self.plan.config.replace(**kwargs).compile()
+            # Already complete and validated
+            kwargs = dict(self.plan.kwargs)
+        else:
+            kwargs = check_kwargs(kwargs, DEFAULT_KW)
         self.verbose = kwargs['verbose']
-        flag = self.do_radar_check(radar)
+        objects = resolve_kwarg_objects(kwargs)
+        self.geometry_cache = objects['geometry_cache']
+        self.instrument = objects['instrument']
+        self.stage_timing = []
+        flag = self.measure('read', self.do_radar_check, radar)
         if not flag:
             return
+        self.subset = None
+        if kwargs['sweeps'] is not None or \
+           kwargs['range_limits'] is not None or \
+           kwargs['azimuth_limits'] is not None:
+            self.subset = self.get_subset_index(kwargs)
+            if self.subset is None:
+                return
+            self.full_radar = self.radar
+            self.radar = _subset_radar(self.radar, rays=self.subset[0],
+                                       gates=self.subset[1])
         self.name_dz = kwargs['dz']
         self.name_dr = kwargs['dr']
         self.name_kd = kwargs['kd']
@@ -213,49 +544,660 @@ class DualPolRetrieval(object):
         self.gs = kwargs['gs']
         self.name_sdp = kwargs['name_sdp']
         self.kdp_window = kwargs['kdp_window']
-        flag = self.do_name_check()
-        if not flag:
-            return
-
-        # Get sounding info
+        self.name_fdp = 'FDP_' + self.kdp_method
+        self.name_fhc = kwargs['name_fhc']
         self.T_flag = kwargs['use_temp']
         self.T_factor = kwargs['fhc_T_factor']
-        self.get_sounding(kwargs['sounding'])
         self.winter_flag = kwargs['winter']
+        self.dz_range = kwargs['dz_range']
+        self.dr_thresh = kwargs['thresh_dr']
+        self.speckle = kwargs['speckle']
+        self.fhc_weights = kwargs['fhc_weights']
+        self.fhc_method = kwargs['fhc_method']
+        self.band = kwargs['band']
+        self.output_precision = kwargs['output_precision']
+        self.kwargs = kwargs
+        self.stages_done = set()
+        self.kdp_needed = False
+        self.qc_mask = None
+        self.grids = {}
+        self.kdp_timing = None
+        self.kdp_cache = objects['kdp_cache']
+        self.result_cache = objects['result_cache']
+        self.buffer_pool = objects['buffer_pool']
+        cache_key = None
+        if self.result_cache is not None and not kwargs['lazy']:
+            radar = self.full_radar if self.subset is not None else self.radar
+            self.input_fields = list(radar.fields)
+            cache_key = self.result_cache.key(
+                radar, kwargs, kwargs_key=self.plan.result_key
+                if self.plan is not None else None)
+            if self.measure('result_cache', self.load_result, cache_key):
+                return
+        if kwargs['sweep_workers'] is not None or \
+           kwargs['block_size'] is not None:
+            self.measure('blocks', self.retrieve_by_blocks, kwargs)
+            if self.success and self.subset is not None and \
+               kwargs['subset_output'] == 'full':
+                self.place_subset()
+            if self.success and cache_key is not None:
+                self.measure('result_cache', self.store_result, cache_key)
+            return
+        flag = self.measure('name_check', self.do_name_check)
+        if not flag:
+            return
+        self.init_volume_mask()
+
+        if kwargs['lazy']:
+            # Products are computed when first looked up in radar.fields
+            self.radar.fields = LazyFields(self.radar.fields, self)
+        else:
+            if self.plan is not None:
+                stages = self.plan.stages
+            else:
+                stages = plan_stages(kwargs)
+            if not self.run_stage(stages[0]):  # KDP
+                return
+            for stage in stages[1:]:
+                self.run_stage(stage)
+            if self.subset is not None and kwargs['subset_output'] == 'full':
+                self.place_subset()
+        self.success = True
+        if cache_key is not None:
+            self.measure('result_cache', self.store_result, cache_key)
+
+    def store_result(self, key):
+        """
+        Stores the fields this retrieval added (and the volume mask, which
+        carries QC) in self.result_cache under key.
+        """
+        mask = self.volume_mask.mask
+        arrays = {'mask': np.packbits(mask)}
+        fields = []
+        for name in self.radar.fields:
+            data = self.radar.fields[name]['data']
+            new = name not in self.input_fields
+            if not new and name != self.name_dz:
+                continue
+            entry = {'name': name, 'own_mask': np.ma.getmask(data) is not mask}
+            if new:
+                arrays['data%d' % len(fields)] = np.ma.getdata(data)
+                entry['attrs'] = dict([
+                    (key, value) for key, value in
+                    self.radar.fields[name].items() if key != 'data'])
+            if entry['own_mask']:
+                arrays['mask%d' % len(fields)] = np.packbits(
+                    np.ma.getmaskarray(data))
+            fields.append(entry)
+        meta = {'fields': fields, 'shape': list(mask.shape),
+                'name_kd': self.name_kd, 'name_fdp': self.name_fdp,
+                'stages_done': sorted(self.stages_done - set(['sounding',
+                                                              'grid']))}
+        if self.qc_mask is not None:
+            arrays['qc_mask'] = np.packbits(self.qc_mask)
+            meta['qc_shape'] = list(self.qc_mask.shape)
+        self.result_cache.put(key, meta, arrays)
+
+    def load_result(self, key):
+        """
+        Adds the fields stored in self.result_cache under key to the radar
+        object, as if they had just been retrieved. Returns False if there
+        is no such entry.
+        """
+        entry = self.result_cache.get(key)
+        if entry is None:
+            return False
+        meta, arrays = entry
+        if self.subset is not None and self.kwargs['subset_output'] == 'full':
+            self.radar = self.full_radar
+            del self.full_radar
+        shape = tuple(meta['shape'])
+
+        def unpack(array, shape=shape):
+            return np.unpackbits(array)[:shape[0] * shape[1]].reshape(
+                shape).astype(bool)
+
+        self.volume_mask = VolumeMask(unpack(arrays['mask']))
+        for i, entry in enumerate(meta['fields']):
+            if 'data%d' % i in arrays:
+                field_dict = dict(entry['attrs'])
+                data = arrays['data%d' % i]
+            else:
+                field_dict = self.radar.fields[entry['name']]
+                data = field_dict['data']
+            if entry['own_mask']:
+                field_dict['data'] = np.ma.masked_array(
+                    np.ma.getdata(data), mask=unpack(arrays['mask%d' % i]),
+                    fill_value=getattr(data, 'fill_value', None))
+            else:
+                field_dict['data'] = self.volume_mask.wrap(
+                    data, fill_value=getattr(data, 'fill_value', None))
+            self.radar.add_field(entry['name'], field_dict,
+                                 replace_existing=True)
+        if 'qc_mask' in arrays:
+            self.qc_mask = unpack(arrays['qc_mask'], tuple(meta['qc_shape']))
+        self.name_kd = meta['name_kd']
+        self.name_fdp = meta['name_fdp']
+        self.kdp_needed = self.name_kd not in self.input_fields
+        self.stages_done = set(meta['stages_done'])
+        self.radar_z = None
+        self.radar_T = None
+        self.success = True
+        if self.kwargs['grid'] is not None:
+            self.run_stage('grid')
+        return True
+
+    def get_subset_index(self, kwargs):
+        """
+        Returns (rays, gates) selecting the sweeps, range interval, and
+        azimuth sector given by the sweeps, range_limits, and azimuth_limits
+        keywords. Each is a slice where possible (so field data are views),
+        otherwise rays is a sorted index array. Returns None if no gates are
+        selected.
+        """
+        radar = self.radar
+        rays = np.arange(radar.nrays)
+        if kwargs['sweeps'] is not None:
+            starts = radar.sweep_start_ray_index['data']
+            ends = radar.sweep_end_ray_index['data']
+            rays = np.unique(np.concatenate(
+                [np.arange(starts[i], ends[i] + 1)
+                 for i in np.atleast_1d(kwargs['sweeps'])]))
+        if kwargs['azimuth_limits'] is not None:
+            az = radar.azimuth['data'][rays] % 360.0
+            az0, az1 = [angle % 360.0 for angle in kwargs['azimuth_limits']]
+            if az0 <= az1:
+                rays = rays[(az >= az0) & (az <= az1)]
+            else:  # Sector crosses north
+                rays = rays[(az >= az0) | (az <= az1)]
+        gates = slice(None)
+        if kwargs['range_limits'] is not None:
+            rng = radar.range['data']
+            index = np.flatnonzero((rng >= kwargs['range_limits'][0]) &
+                                   (rng <= kwargs['range_limits'][1]))
+            if len(index) > 0:
+                gates = slice(index[0], index[-1] + 1)
+            else:
+                rays = rays[:0]
+        if len(rays) == 0:
+            self.fail('No gates in the requested sweeps/range/azimuths')
+            return None
+        if np.all(np.diff(rays) == 1):
+            rays = slice(rays[0], rays[-1] + 1)
+        return rays, gates
+
+    def place_subset(self):
+        """
+        Puts the fields retrieved for a subset (see get_subset_index) back in
+        the full radar object, which becomes self.radar again. Reflectivity
+        keeps a mask of its own, with any QC applied within the subset. The
+        retrieved fields share self.volume_mask, which also masks every gate
+        outside the subset.
+        """
+        full = self.full_radar
+        rays, gates = self.subset
+        shape = (full.nrays, full.ngates)
+        new = OrderedDict([(name, dict.__getitem__(self.radar.fields, name))
+                           for name in self.radar.fields
+                           if name not in full.fields])
+        outputs = OrderedDict()
+        self.write_block((rays, gates), new, outputs, shape=shape,
+                         fill=self.bad)
+        dz = full.fields[self.name_dz]
+        mask = np.array(np.ma.getmaskarray(dz['data']))
+        mask[rays, gates] = self.volume_mask.mask
+        dz['data'] = np.ma.masked_array(
+            np.ma.getdata(dz['data']), mask=mask, copy=False,
+            fill_value=getattr(dz['data'], 'fill_value', None))
+        outside = np.ones(shape, dtype=bool)
+        outside[rays, gates] = False
+        self.volume_mask = VolumeMask(np.logical_or(mask, outside))
+        for name in outputs:
+            field_dict = outputs[name]
+            if 'mask' in field_dict:
+                field_dict['data'] = np.ma.masked_array(
+                    field_dict['data'], mask=field_dict.pop('mask'),
+                    copy=False)
+            else:
+                field_dict['data'] = self.volume_mask.wrap(field_dict['data'])
+            full.add_field(name, field_dict, replace_existing=True)
+        self.radar = full
+        del self.full_radar
+
+    def stage_dependencies(self, stage):
+        """Returns the list of stages that must run before a given stage."""
+        deps = {'kdp': [], 'sounding': [], 'qc': ['kdp'],
+                'fhc': ['kdp', 'qc', 'sounding'], 'precip': ['kdp', 'qc'],
+                'dsd': ['kdp', 'qc'], 'mass': ['qc', 'sounding'],
+                'grid': []}[stage]
+        if stage == 'grid':
+            products = self.product_stages()
+            deps = [products[name] for name in self.grid_field_names()
+                    if name in products]
+        if stage == 'precip' and self.kwargs['rain_method'] == 'hidro' and \
+           ('fhc' in self.stages_done or
+                self.name_fhc not in self.radar.fields):
+            deps = deps + ['fhc']
+        return deps
+
+    def reconfigure(self, **kwargs):
+        """
+        Changes retrieval keywords (see RECONFIGURE_STAGES for those allowed)
+        and recomputes only the stages affected by them, reusing everything
+        else (e.g., new fhc_weights redo HID and hidro rainfall, but not KDP,
+        QC, gate heights/temperatures, DSD, or mass). Turning on a *_flag
+        runs that stage; products of stages turned off are kept. With
+        lazy=True, affected products are dropped and recomputed when next
+        looked up. Not available with sweep_workers or block_size.
+        Returns False if the keywords could not be applied or a stage failed.
+        """
+        if self.kwargs['sweep_workers'] is not None or \
+           self.kwargs['block_size'] is not None or \
+           (self.subset is not None and not self.kwargs['lazy'] and
+                self.kwargs['subset_output'] == 'full'):
+            warnings.warn('reconfigure() not available with sweep_workers, '
+                          'block_size, or a subset placed back in the full '
+                          'volume, make a new DualPolRetrieval')
+            return False
+        for key in kwargs:
+            if key not in RECONFIGURE_STAGES:
+                warnings.warn(key + ' cannot be reconfigured, '
+                              'make a new DualPolRetrieval')
+                return False
+        self.kwargs.update(kwargs)
+        attributes = {'use_temp': 'T_flag', 'fhc_T_factor': 'T_factor',
+                      'winter': 'winter_flag', 'thresh_dr': 'dr_thresh'}
+        for key in kwargs:
+            if key in attributes or hasattr(self, key):
+                setattr(self, attributes.get(key, key), kwargs[key])
+        # Stages already done that must be redone, in dependency order
+        changed = set()
+        for key in kwargs:
+            changed.update(RECONFIGURE_STAGES[key])
+        redo = []
+        for stage in STAGE_ORDER:
+            if stage in self.stages_done and \
+               (stage in changed or
+                    set(self.stage_dependencies(stage)).intersection(redo)):
+                redo.append(stage)
+        if self.verbose:
+            print('Recomputing stages:', redo)
+        if 'qc' in redo and self.qc_mask is not None:
+            self.volume_mask.remove(self.qc_mask)
+            self.qc_mask = None
+        self.stages_done.difference_update(redo)
+        products = self.product_stages()
+        for name in products:
+            if products[name] in redo:
+                dict.pop(self.radar.fields, name, None)
+        if self.kwargs['lazy']:
+            return True
+        for stage in STAGE_ORDER:
+            if stage in redo or (stage in STAGE_FLAGS and
+                                 self.kwargs[STAGE_FLAGS[stage]]):
+                if not self.run_stage(stage):
+                    return False
+        return True
+
+    def grid_field_names(self):
+        """Returns the names of the fields the 'grid' stage maps."""
+        names = self.kwargs['grid_fields']
+        if names is None:
+            products = self.product_stages()
+            names = [name for name in [self.name_fhc, 'rain', 'D0', 'MW', 'MI']
+                     if self.kwargs['lazy'] or
+                     self.kwargs[STAGE_FLAGS[products[name]]]]
+        return names
+
+    def product_stages(self):
+        """
+        Returns a dict mapping each retrievable field name to its stage.
+        KDP, FDP, and SDP are only included if KDP is calculated here rather
+        than given as an input field.
+        """
+        products = {self.name_fhc: 'fhc', 'FH_CONF': 'fhc'}
+        if self.kdp_needed:
+            for name in [self.name_kd, self.name_fdp, self.name_sdp]:
+                products[name] = 'kdp'
+        for name in ['rain', 'method', 'ZDP', 'FI']:
+            products[name] = 'precip'
+        for name in ['D0', 'NW', 'MU']:
+            products[name] = 'dsd'
+        for name in ['MW', 'MI']:
+            products[name] = 'mass'
+        return products
+
+    def run_stage(self, stage):
+        """
+        Runs a retrieval stage (see STAGE_ORDER) if it has not run yet,
+        first running any stages it depends on. Returns False if the stage
+        could not be run.
+        """
+        if stage in self.stages_done:
+            return True
+        for dep in self.stage_dependencies(stage):
+            if not self.run_stage(dep):
+                return False
+        if self.measure(stage, getattr(self, '_stage_' + stage)) is False:
+            return False
+        self.stages_done.add(stage)
+        return True
+
+    def measure(self, stage, func, *args, **kwargs):
+        """
+        Calls func(*args, **kwargs) and returns its result. With
+        instrumentation on, the call is also recorded in self.stage_timing
+        under the given stage name.
+        """
+        if self.instrument is None:
+            return func(*args, **kwargs)
+        result, record = self.instrument.measure(stage, func, *args, **kwargs)
+        self.stage_timing.append(record)
+        return result
+
+    def timing_report(self):
+        """Returns a text table of the stage timings in self.stage_timing."""
+        lines = ['%-12s %10s %10s %14s %14s' %
+                 ('stage', 'wall (s)', 'cpu (s)', 'rss delta (B)',
+                  'peak alloc (B)')]
+        for rec in self.stage_timing:
+            lines.append('%-12s %10.4f %10.4f %14s %14s' %
+                         (rec.stage, rec.wall, rec.cpu, rec.rss_delta,
+                          rec.peak_bytes))
+        lines.append('%-12s %10.4f %10.4f' %
+                     ('total', sum([rec.wall for rec in self.stage_timing]),
+                      sum([rec.cpu for rec in self.stage_timing])))
+        return '\n'.join(lines)
+
+    def get_product(self, name):
+        """
+        Returns the radar field dictionary for a retrieved product,
+        computing it (and whatever it depends on) if needed.
+        """
+        if dict.__contains__(self.radar.fields, name):
+            return dict.__getitem__(self.radar.fields, name)
+        stage = self.product_stages().get(name)
+        if stage is None or not self.run_stage(stage) or \
+           not dict.__contains__(self.radar.fields, name):
+            raise KeyError(name)
+        return dict.__getitem__(self.radar.fields, name)
+
+    def _stage_kdp(self):
+        if self.kdp_needed:
+            return self.calculate_kdp()
+
+    def _stage_sounding(self):
+        self.get_sounding(self.kwargs['sounding'])
 
-        # Do QC
-        if kwargs['qc_flag']:
+    def _stage_qc(self):
+        if self.kwargs['qc_flag']:
             if self.verbose:
                 print('Performing QC')
-            self.dz_range = kwargs['dz_range']
-            self.dr_thresh = kwargs['thresh_dr']
-            self.speckle = kwargs['speckle']
             self.do_qc()
 
-        # Do FHC
-        self.name_fhc = kwargs['name_fhc']
-        if kwargs['fhc_flag']:
-            if self.verbose:
-                print('Performing FHC')
-            self.fhc_weights = kwargs['fhc_weights']
-            self.fhc_method = kwargs['fhc_method']
-            self.band = kwargs['band']
-            self.get_hid()
-
-        # Other precip retrievals
-        if kwargs['precip_flag']:
-            if self.verbose:
-                print('Performing precip rate calculations')
-            self.get_precip_rate(ice_flag=kwargs['ice_flag'],
-                                 rain_method=kwargs['rain_method'])
-        if kwargs['dsd_flag']:
-            if self.verbose:
-                print('Performing DSD calculations')
-            self.get_dsd()
-        if kwargs['liquid_ice_flag']:
-            if self.verbose:
-                print('Performing mass calculations')
-            self.get_liquid_and_frozen_mass()
+    def _stage_fhc(self):
+        if self.verbose:
+            print('Performing FHC')
+        self.get_hid()
+
+    def _stage_precip(self):
+        if self.verbose:
+            print('Performing precip rate calculations')
+        if self.kwargs['fused']:
+            return self.run_fused('precip')
+        self.get_precip_rate(ice_flag=self.kwargs['ice_flag'],
+                             rain_method=self.kwargs['rain_method'])
+
+    def _stage_dsd(self):
+        if self.verbose:
+            print('Performing DSD calculations')
+        if self.kwargs['fused']:
+            return self.run_fused('dsd')
+        self.get_dsd()
+
+    def _stage_mass(self):
+        if self.verbose:
+            print('Performing mass calculations')
+        if self.kwargs['fused']:
+            return self.run_fused('mass')
+        self.get_liquid_and_frozen_mass()
+
+    def run_fused(self, stage):
+        """
+        Runs a 'precip', 'dsd', or 'mass' stage through get_fused_products()
+        along with whichever of the others are switched on, not done yet,
+        and ready to run (unless lazy, where only the stage asked for runs).
+        """
+        stages = [stage]
+        if not self.kwargs['lazy']:
+            for other in ['precip', 'dsd', 'mass']:
+                if other != stage and other not in self.stages_done and \
+                   self.kwargs[STAGE_FLAGS[other]] and \
+                   set(self.stage_dependencies(other)).issubset(
+                       self.stages_done):
+                    stages.append(other)
+        self.get_fused_products(stages)
+        self.stages_done.update(stages)
+
+    def _stage_grid(self):
+        if self.verbose:
+            print('Gridding products')
+        products = self.product_stages()
+        names = [name for name in self.grid_field_names()
+                 if name in self.radar.fields or
+                 (self.kwargs['lazy'] and name in products)]
+        self.grids = self.kwargs['grid'].grid(
+            self.radar, names, categorical=[self.name_fhc, 'method'])
+
+    def retrieve_by_blocks(self, kwargs):
+        """
+        Splits the volume into blocks of rays (by sweep, or block_size rays
+        at a time) and runs the full retrieval chain on each block, either
+        one block at a time or in a thread/process pool. Each block's
+        results are written into preallocated output fields as soon as the
+        block is done, so only the outputs and the blocks in flight are held
+        in memory.
+        """
+        nrays = self.radar.nrays
+        if kwargs['block_size'] is not None:
+            size = max(1, int(kwargs['block_size']))
+            rays = [slice(i, min(i + size, nrays))
+                    for i in range(0, nrays, size)]
+        else:
+            starts = self.radar.sweep_start_ray_index['data']
+            ends = self.radar.sweep_end_ray_index['data']
+            rays = [slice(i, j + 1) for i, j in zip(starts, ends)]
+        nworkers = kwargs['sweep_workers']
+        if self.verbose:
+            print('Retrieving', len(rays), 'blocks with',
+                  nworkers or 1, 'worker(s)')
+        inputs = [kwargs[key] for key in
+                  ['dz', 'dr', 'rh', 'ld', 'kd', 'dp', 'name_sdp', 'name_fhc']
+                  if kwargs[key] in self.radar.fields]
+        block_kw = dict(kwargs)
+        block_kw['sweep_workers'] = None
+        block_kw['block_size'] = None
+        block_kw['instrument'] = None
+        block_kw['grid'] = None
+        block_kw['kdp_workers'] = None
+        block_kw['result_cache'] = None
+        block_kw['buffer_pool'] = None
+        block_kw['lazy'] = False  # Blocks only return computed fields
+        block_kw['sweeps'] = None
+        block_kw['azimuth_limits'] = None
+        radar = self.radar
+        if self.subset is not None and self.subset[1] != slice(None):
+            # Blocks keep full rays for KDP and trim the range themselves
+            radar = _subset_radar(self.full_radar, rays=self.subset[0],
+                                  fields=inputs)
+            block_kw['subset_output'] = 'trim'
+        else:
+            block_kw['range_limits'] = None
+        if self.name_dz not in self.radar.fields:
+            self.fail(self.name_dz +
+                      ' field not in radar object, check variable names')
+            return
+        self.init_volume_mask()
+        if kwargs['liquid_ice_flag'] and kwargs['freezing_level'] is None \
+           and kwargs['sounding'] is not None:
+            # Blocks would each find their own from just their gates
+            self.measure('sounding', self.get_sounding, kwargs['sounding'])
+            block_kw['freezing_level'] = self.get_freezing_level()
+            self.radar_z = None
+            self.radar_T = None
+        tasks = ((_subset_radar(radar, rays=sl, fields=inputs), inputs,
+                  block_kw) for sl in rays)
+        pool = None
+        if nworkers is None:
+            nworkers = 1
+            results = (_block_worker(task) for task in tasks)
+        else:
+            nworkers = max(1, int(nworkers))
+            if kwargs['sweep_pool'] == 'process':
+                pool = multiprocessing.Pool(nworkers)
+            else:
+                pool = ThreadPool(nworkers)
+            results = pool.imap(_block_worker, tasks)
+        start = time.time()
+        outputs = OrderedDict()
+        block_elapsed = []
+        block_cpu = []
+        try:
+            for i, (flag, fields, elapsed, cpu) in enumerate(results):
+                if not flag:
+                    self.fail('Retrieval failed for one or more blocks')
+                    return
+                self.write_block(rays[i], fields, outputs)
+                block_elapsed.append(elapsed)
+                block_cpu.append(cpu)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        elapsed = time.time() - start
+        if self.name_kd is None or self.name_kd not in self.radar.fields:
+            self.name_kd = 'KDP_' + self.kdp_method
+            self.kdp_needed = True  # Computed by the blocks
+        if self.name_dz in outputs:
+            self.volume_mask.add(outputs.pop(self.name_dz))
+        for name in outputs:
+            field_dict = outputs[name]
+            if 'mask' in field_dict:
+                field_dict['data'] = np.ma.masked_array(
+                    field_dict['data'], mask=field_dict.pop('mask'),
+                    copy=False)
+            else:
+                field_dict['data'] = self.volume_mask.wrap(field_dict['data'])
+            self.radar.add_field(name, field_dict, replace_existing=True)
+        if kwargs['grid'] is not None:
+            self.measure('grid', self._stage_grid)
+        # Block wall times include waiting on other blocks for a CPU, so
+        # the blocks' CPU time is the estimate of serial time
+        serial = sum(block_cpu)
+        self.sweep_timing = {'workers': nworkers, 'pool': kwargs['sweep_pool'],
+                             'blocks': len(rays), 'elapsed': elapsed,
+                             'block_elapsed': block_elapsed,
+                             'block_cpu': block_cpu,
+                             'speedup': serial / elapsed,
+                             'efficiency': serial / elapsed / nworkers}
+        if self.verbose:
+            print('Speedup of %.2f with %d worker(s)' %
+                  (self.sweep_timing['speedup'], nworkers))
+        self.success = True
+
+    def write_block(self, rays, fields, outputs, shape=None, fill=None):
+        """
+        Writes one block's retrieval fields into full-volume field
+        dictionaries held in outputs, preallocating each on first use.
+        rays is the slice/indices of the block's rays in the volume (or a
+        (rays, gates) tuple). shape defaults to that of self.radar. If the
+        blocks won't cover the volume, give a fill value (used unless a
+        field has its own _FillValue) for the rest.
+        """
+        if shape is None:
+            shape = (self.radar.nrays, self.radar.ngates)
+        for name in fields:
+            block = fields[name]['data']
+            if name == self.name_dz:
+                # Only the QC mask of the reflectivity field is kept
+                if name not in outputs:
+                    outputs[name] = self.new_buffer(shape, bool, fill=False)
+                outputs[name][rays] = np.ma.getmaskarray(block)
+                continue
+            if name not in outputs:
+                field_dict = dict(fields[name])
+                if fill is not None:
+                    fill = field_dict.get('_FillValue', fill)
+                field_dict['data'] = self.new_buffer(shape, block.dtype,
+                                                     fill=fill)
+                if '_Write_as_dtype' in field_dict and \
+                   np.ma.getmask(block) is not np.ma.nomask:
+                    # Packed fields also mask bad values, so own their mask
+                    field_dict['mask'] = self.new_buffer(
+                        shape, bool, fill=fill is not None)
+                outputs[name] = field_dict
+            outputs[name]['data'][rays] = np.ma.getdata(block)
+            if 'mask' in outputs[name]:
+                outputs[name]['mask'][rays] = np.ma.getmaskarray(block)
+
+    def fail(self, message):
+        """
+        Warns that the retrieval can't go on, and keeps the message in
+        self.errors (without relying on the global warning filters, so that
+        retrievals in threads don't see each other's messages).
+        """
+        self.errors.append(message)
+        warnings.warn(message)
+
+    def new_buffer(self, shape, dtype, fill=None):
+        """
+        Returns an array for a product, from self.buffer_pool if set, filled
+        with fill if given.
+        """
+        if self.buffer_pool is None:
+            array = np.empty(shape, dtype=dtype)
+        else:
+            array = self.buffer_pool.get(shape, dtype)
+        if fill is not None:
+            array.fill(fill)
+        return array
+
+    def pooled(self, data, dtype=None):
+        """
+        Returns data as dtype, converted into an array from
+        self.buffer_pool if set (else a new one). Data already of that dtype
+        (or with dtype None) are returned unchanged. Data from the pool that
+        are converted go back to it, so must not be used afterwards.
+        """
+        if dtype is None or np.dtype(dtype) == data.dtype:
+            return data
+        if self.buffer_pool is None:
+            return data.astype(dtype)
+        array = self.new_buffer(data.shape, dtype)
+        np.copyto(array, data, casting='unsafe')
+        if self.buffer_pool is not None and \
+           _base_array(data).nbytes == data.nbytes:  # Not part of a buffer
+            self.buffer_pool.release(data)
+        return array
+
+    def release(self):
+        """
+        Returns the arrays of the retrieved fields to self.buffer_pool, for
+        reuse by later volumes, and removes those fields from the radar
+        object. Any references still held to their data must no longer be
+        used.
+        """
+        if self.buffer_pool is None:
+            return
+        for name in list(self.radar.fields):
+            field_dict = dict.__getitem__(self.radar.fields, name)
+            if self.buffer_pool.owns(field_dict['data']):
+                if np.ma.getmask(field_dict['data']) is not \
+                   self.volume_mask.mask:
+                    self.buffer_pool.release(np.ma.getmask(
+                        field_dict['data']))
+                self.buffer_pool.release(field_dict['data'])
+                del self.radar.fields[name]
 
     def do_radar_check(self, radar):
         """
@@ -265,7 +1207,7 @@ class DualPolRetrieval(object):
             try:
                 self.radar = pyart.io.read(radar)
             except:
-                warnings.warn('Bad file name provided, try again')
+                self.fail('Bad file name provided, try again')
                 return False
         else:
             self.radar = radar
@@ -273,7 +1215,7 @@ class DualPolRetrieval(object):
         try:
             junk = self.radar.latitude['data']
         except:
-            warnings.warn('Need a real Py-ART radar object, try again')
+            self.fail('Need a real Py-ART radar object, try again')
             return False
         return True  # Actual radar object provided by user
 
@@ -298,23 +1240,36 @@ class DualPolRetrieval(object):
                         if self.name_kd not in self.radar.fields:
                             if self.verbose:
                                 print('Not finding KDP field, calculating')
-                            kdp_flag = self.calculate_kdp()
+                            kdp_flag = self.check_kdp_inputs()
                         else:
                             kdp_flag = True
                     else:
                         if self.verbose:
                             print('Not provided KDP field, calculating')
-                        kdp_flag = self.calculate_kdp()
+                        kdp_flag = self.check_kdp_inputs()
                     return kdp_flag  # All required variables present?
                 else:
-                    warnings.warn(self.name_rh+wstr)
+                    self.fail(self.name_rh+wstr)
                     return False
             else:
-                warnings.warn(self.name_dr+wstr)
+                self.fail(self.name_dr+wstr)
                 return False
         else:
-            warnings.warn(self.name_dz+wstr)
+            self.fail(self.name_dz+wstr)
+            return False
+
+    def check_kdp_inputs(self):
+        """
+        Flags KDP for calculation by the 'kdp' stage, after checking that
+        differential phase is available to calculate it from.
+        """
+        if self.name_dp is None or self.name_dp not in self.radar.fields:
+            self.fail(
+                'Missing differential phase and KDP fields, failing ...')
             return False
+        self.kdp_needed = True
+        self.name_kd = 'KDP_' + self.kdp_method
+        return True
 
     def calculate_kdp(self):
         """
@@ -323,38 +1278,74 @@ class DualPolRetrieval(object):
         wstr = 'Missing differential phase and KDP fields, failing ...'
         if self.name_dp is not None:
             if self.name_dp in self.radar.fields:
-                if self.kdp_method.upper() == 'CSU':
-                    kdp = self.call_csu_kdp()
+                if self.kdp_method.upper() not in KDP_BACKENDS:
+                    self.fail('Unknown kdp_method ' + self.kdp_method +
+                              ', failing ...')
+                    return False
+                kdp = self.call_kdp_backend()
                 self.name_kd = 'KDP_' + self.kdp_method
                 self.add_field_to_radar_object(
                     kdp, standard_name='KDP',
                     field_name=self.name_kd, units='deg km-1',
                     long_name='Specific Differential Phase')
             else:
-                warnings.warn(wstr)
+                self.fail(wstr)
                 return False
         else:
-            warnings.warn(wstr)
+            self.fail(wstr)
             return False
         return True
 
     def call_csu_kdp(self):
         """
         Calls the csu_radartools.csu_kdp module to obtain KDP, FDP, and SDP.
+        Kept for backward compatibility, same as call_kdp_backend() with
+        kdp_method='CSU'.
+        """
+        return self.call_kdp_backend()
+
+    def call_kdp_backend(self):
+        """
+        Calls the KDP backend registered for kdp_method (see
+        register_kdp_backend) to obtain KDP, FDP, and SDP, splitting the
+        rays among kdp_workers if set. Throughput is stored in
+        self.kdp_timing.
         """
         if self.verbose:
-            print('Calculating KDP via CSU method')
-        dp = self.extract_unmasked_data(self.name_dp)
-        dz = self.extract_unmasked_data(self.name_dz)
-        kdp = np.zeros_like(dp) + self.bad
-        fdp = kdp * 1.0
-        sdp = kdp * 1.0
-        rng = self.radar.range['data'] / RNG_MULT
-        az = self.radar.azimuth['data']
-        rng2d, az2d = np.meshgrid(rng, az)
-        kdp, fdp, sdp = \
-            csu_kdp.calc_kdp_bringi(dp=dp, dz=dz, rng=rng2d, gs=self.gs,
-                                    thsd=self.thresh_sdp, bad=self.bad)
+            print('Calculating KDP via ' + self.kdp_method + ' method')
+        radar = self.radar
+        if self.subset is not None and self.subset[1] != slice(None):
+            # The KDP filter runs along whole rays, so give it their full
+            # range and trim the results to the subset
+            radar = _subset_radar(self.full_radar, rays=self.subset[0],
+                                  fields=[self.name_dp, self.name_dz])
+        dp = self.extract_unmasked_data(self.name_dp, radar=radar)
+        dz = self.extract_unmasked_data(self.name_dz, radar=radar)
+        rng = radar.range['data'] / RNG_MULT
+        result = None
+        if self.kdp_cache is not None:
+            key = self.kdp_cache.key(
+                dp, dz, gs=self.gs, thresh_sdp=self.thresh_sdp,
+                kdp_window=self.kdp_window, bad=self.bad,
+                kdp_method=self.kdp_method)
+            result = self.kdp_cache.get(key)
+            if self.verbose and result is not None:
+                print('Using cached KDP')
+        if result is None:
+            result, self.kdp_timing = run_kdp_backend(
+                dp, dz, rng, method=self.kdp_method,
+                workers=self.kwargs['kdp_workers'],
+                pool=self.kwargs['kdp_pool'],
+                chunk_size=self.kwargs['kdp_chunk_size'], gs=self.gs,
+                thresh_sdp=self.thresh_sdp, bad=self.bad,
+                window=self.kdp_window)
+            if self.verbose:
+                print('KDP at %.0f rays/s' % self.kdp_timing['rays_per_sec'])
+            if self.kdp_cache is not None:
+                self.kdp_cache.put(key, *result)
+        if radar is not self.radar:
+            result = [field[:, self.subset[1]] for field in result]
+        kdp, fdp, sdp = result
         self.name_fdp = 'FDP_'+self.kdp_method
         self.add_field_to_radar_object(
             fdp, units='deg', standard_name='Filtered Differential Phase',
@@ -366,9 +1357,14 @@ class DualPolRetrieval(object):
             long_name='Standard Deviation of Differential Phase')
         return kdp
 
-    def extract_unmasked_data(self, field, bad=None):
-        """Extracts an unmasked field from the radar object."""
-        var = self.radar.fields[field]['data']
+    def extract_unmasked_data(self, field, bad=None, radar=None):
+        """
+        Extracts an unmasked field from the radar object (default
+        self.radar).
+        """
+        if radar is None:
+            radar = self.radar
+        var = radar.fields[field]['data']
         if hasattr(var, 'mask'):
             if bad is None:
                 bad = self.bad
@@ -377,8 +1373,9 @@ class DualPolRetrieval(object):
 
     def get_sounding(self, sounding):
         """
-        Ingests the sounding (either a skewt - i.e., UWYO - formatted file
-        or a properly formatted dict).
+        Ingests the sounding (either a skewt - i.e., UWYO - formatted file,
+        a properly formatted dict, a Sounding object, or a pair of Sounding
+        objects bracketing the scan time).
         """
         if sounding is None:
             print('No sounding provided')
@@ -386,21 +1383,36 @@ class DualPolRetrieval(object):
         else:
             if isinstance(sounding, str):
                 try:
-                    snd = SkewT.Sounding(sounding)
-                    # Test for new version of skewt package
-                    if hasattr(snd, 'soundingdata'):
-                        self.snd_T = snd.soundingdata['temp']
-                        self.snd_z = snd.soundingdata['hght']
-                    else:
-                        self.snd_T = snd.data['temp']
-                        self.snd_z = snd.data['hght']
+                    snd = read_sounding(sounding)
+                    self.snd_T = snd.T
+                    self.snd_z = snd.z
                 except:
                     print('Sounding read fail')
                     self.T_flag = False
+            elif isinstance(sounding, (list, tuple)) and len(sounding) == 2:
+                try:
+                    snd = interpolate_soundings(
+                        sounding[0], sounding[1], get_radar_time(self.radar))
+                    self.snd_T = snd.T
+                    self.snd_z = snd.z
+                except:
+                    print('Sounding time interpolation fail')
+                    self.T_flag = False
+            elif isinstance(sounding, Sounding):
+                self.snd_T = sounding.T
+                self.snd_z = sounding.z
             else:
                 try:
-                    self.snd_T = sounding['T']
-                    self.snd_z = sounding['z']
+                    # Already parsed skewt Sounding objects, or dict/array
+                    if hasattr(sounding, 'soundingdata'):
+                        self.snd_T = sounding.soundingdata['temp']
+                        self.snd_z = sounding.soundingdata['hght']
+                    elif isinstance(getattr(sounding, 'data', None), dict):
+                        self.snd_T = sounding.data['temp']
+                        self.snd_z = sounding.data['hght']
+                    else:
+                        self.snd_T = sounding['T']
+                        self.snd_z = sounding['z']
                 except:
                     print('Sounding in wrong data format')
                     self.T_flag = False
@@ -427,7 +1439,22 @@ class DualPolRetrieval(object):
             print('Despeckling')
         mask_ds = csu_misc.despeckle(dz_qc, bad=self.bad, ngates=self.speckle)
         final_mask = np.logical_or(new_mask, mask_ds)
-        setattr(self.radar.fields[self.name_dz]['data'], 'mask', final_mask)
+        # Keep the gates masked by QC alone, so it can be redone later
+        self.qc_mask = np.logical_and(final_mask,
+                                      np.logical_not(self.volume_mask.mask))
+        self.volume_mask.add(self.qc_mask)
+
+    def init_volume_mask(self):
+        """
+        Builds the VolumeMask from the reflectivity field's mask and points
+        the reflectivity field at it, so that QC and later updates to the
+        volume mask apply to reflectivity and every retrieved field alike.
+        """
+        field = self.radar.fields[self.name_dz]
+        self.volume_mask = VolumeMask(np.ma.getmaskarray(field['data']))
+        field['data'] = self.volume_mask.wrap(
+            field['data'], fill_value=getattr(field['data'], 'fill_value',
+                                              None))
 
     def get_hid(self):
         """Calculate hydrometeror ID, add to radar object."""
@@ -439,26 +1466,62 @@ class DualPolRetrieval(object):
             ld = self.radar.fields[self.name_ld]['data']
         else:
             ld = None
-        if not self.winter_flag:
+        if self.winter_flag:
+            print('Winter HID not enabled yet, sorry!')
+            return
+        nrays, ngates = self.radar.nrays, self.radar.ngates
+        size = nrays
+        if self.kwargs['fhc_block_size'] is not None:
+            size = max(1, int(self.kwargs['fhc_block_size']) // ngates)
+        confidence = self.kwargs['fhc_confidence']
+        # Newer csu_radartools return the classes unless asked for scores
+        extra = {}
+        if _accepts_keyword(csu_fhc.csu_fhc_summer, 'return_scores'):
+            extra['return_scores'] = True
+        fh = self.new_buffer((nrays, ngates), np.intp)
+        conf = self.new_buffer((nrays, ngates), np.uint8) if confidence \
+            else None
+        for start in range(0, nrays, size):
+            rays = slice(start, min(start + size, nrays))
+            T = self.radar_T[rays] if self.radar_T is not None else None
             scores = csu_fhc.csu_fhc_summer(
-                dz=dz, zdr=dr, rho=rh, kdp=kd,
-                ldr=ld, use_temp=self.T_flag, band=self.band,
-                method=self.fhc_method, T=self.radar_T,
+                dz=dz[rays], zdr=dr[rays], rho=rh[rays], kdp=kd[rays],
+                ldr=ld[rays] if ld is not None else None,
+                use_temp=self.T_flag, band=self.band,
+                method=self.fhc_method, T=T,
                 verbose=self.verbose, temp_factor=self.T_factor,
-                weights=self.fhc_weights)
-            fh = np.argmax(scores, axis=0) + 1
-            self.add_field_to_radar_object(fh, field_name=self.name_fhc)
-        else:
-            print('Winter HID not enabled yet, sorry!')
+                weights=self.fhc_weights, **extra)
+            result = hid_argmax(scores, confidence=confidence,
+                                ndim=dz.ndim)
+            fh[rays] = result[0]
+            if confidence:
+                conf[rays] = result[1]
+            del scores
+        self.add_field_to_radar_object(fh, field_name=self.name_fhc)
+        if confidence:
+            self.add_products({'FH_CONF': conf})
 
     def get_precip_rate(self, ice_flag=False, rain_method='hidro'):
         """Calculate rain rate, add to radar object."""
-        dz = self.radar.fields[self.name_dz]['data']
-        dr = self.radar.fields[self.name_dr]['data']
-        kd = self.radar.fields[self.name_kd]['data']
+        results = self.calc_precip_rate(slice(None), ice_flag=ice_flag,
+                                        rain_method=rain_method)
+        if results is None:
+            print('Winter precip not enabled yet, sorry!')
+            return
+        self.add_products(results)
+
+    def calc_precip_rate(self, rays, ice_flag=False, rain_method='hidro'):
+        """
+        Returns rain rate and method (plus ZDP and ice fraction if ice_flag
+        and rain_method isn't 'hidro') for a slice of rays, as a dict.
+        """
+        dz = self.radar.fields[self.name_dz]['data'][rays]
+        dr = self.radar.fields[self.name_dr]['data'][rays]
+        kd = self.radar.fields[self.name_kd]['data'][rays]
+        results = OrderedDict()
         if not self.winter_flag:
             if rain_method == 'hidro':
-                fhc = self.radar.fields[self.name_fhc]['data']
+                fhc = self.radar.fields[self.name_fhc]['data'][rays]
                 rain, method = csu_blended_rain.csu_hidro_rain(dz=dz, zdr=dr,
                                                                kdp=kd, fhc=fhc)
             else:
@@ -468,84 +1531,173 @@ class DualPolRetrieval(object):
                 else:
                     rain, method, zdp, fi = csu_blended_rain.calc_blended_rain(
                         dz=dz, zdr=dr, kdp=kd, ice_flag=ice_flag)
-                    self.add_field_to_radar_object(
-                        zdp, field_name='ZDP', units='dB',
-                        long_name='Difference Reflectivity',
-                        standard_name='Difference Reflectivity')
-                    self.add_field_to_radar_object(
-                        fi, field_name='FI', units='',
-                        long_name='Ice Fraction', standard_name='Ice Fraction')
+                    results['ZDP'] = zdp
+                    results['FI'] = fi
         else:
-            print('Winter precip not enabled yet, sorry!')
-            return
-        self.add_field_to_radar_object(rain, field_name='rain', units='mm h-1',
-                                       long_name='Rainfall Rate',
-                                       standard_name='Rainfall Rate')
-        self.add_field_to_radar_object(method, field_name='method', units='',
-                                       long_name='Rainfall Method',
-                                       standard_name='Rainfall Method')
+            return None
+        results['rain'] = rain
+        results['method'] = method
+        return results
 
     def get_dsd(self):
         """Calculate DSD information, add to radar object."""
-        dz = self.radar.fields[self.name_dz]['data']
-        dr = self.radar.fields[self.name_dr]['data']
-        kd = self.radar.fields[self.name_kd]['data']
+        self.add_products(self.calc_dsd(slice(None)))
+
+    def calc_dsd(self, rays):
+        """Returns D0, NW, and MU for a slice of rays, as a dict."""
+        dz = self.radar.fields[self.name_dz]['data'][rays]
+        dr = self.radar.fields[self.name_dr]['data'][rays]
+        kd = self.radar.fields[self.name_kd]['data'][rays]
         d0, Nw, mu = csu_dsd.calc_dsd(dz=dz, zdr=dr, kdp=kd, band=self.band,
                                       method='2009')
-        self.add_field_to_radar_object(d0, field_name='D0', units='mm',
-                                       long_name='Median Volume Diameter',
-                                       standard_name='Median Volume Diameter')
-        self.add_field_to_radar_object(
-            Nw, field_name='NW', units='mm-1 m-3',
-            long_name='Normalized Intercept Parameter',
-            standard_name='Normalized Intercept Parameter')
-        self.add_field_to_radar_object(mu, field_name='MU', units=' ',
-                                       long_name='Mu', standard_name='Mu')
+        return OrderedDict([('D0', d0), ('NW', Nw), ('MU', mu)])
 
     def get_liquid_and_frozen_mass(self):
         """Calculate liquid/ice mass, add to radar object."""
+        self.add_products(self.calc_liquid_and_frozen_mass(slice(None)))
+
+    def calc_liquid_and_frozen_mass(self, rays):
+        """Returns liquid (MW) and ice (MI) mass for a slice of rays."""
+        T = self.radar_T[rays] if self.radar_T is not None else None
         mw, mi = csu_liquid_ice_mass.calc_liquid_ice_mass(
-                         self.radar.fields[self.name_dz]['data'],
-                         self.radar.fields[self.name_dr]['data'],
-                         self.radar_z/1000.0, T=self.radar_T)
-        self.add_field_to_radar_object(mw, field_name='MW', units='g m-3',
-                                       long_name='Liquid Water Mass',
-                                       standard_name='Liquid Water Mass')
-        self.add_field_to_radar_object(mi, field_name='MI', units='g m-3',
-                                       long_name='Ice Water Mass',
-                                       standard_name='Ice Water Mass')
+                         self.radar.fields[self.name_dz]['data'][rays],
+                         self.radar.fields[self.name_dr]['data'][rays],
+                         self.radar_z[rays]/1000.0, T=T,
+                         Hfrz=self.get_freezing_level())
+        return OrderedDict([('MW', mw), ('MI', mi)])
+
+    def get_freezing_level(self):
+        """
+        Returns the freezing level (km MSL) for the mass retrieval: the
+        freezing_level keyword if set, else found once from the temperature
+        and height of every gate in the volume, so that blocks of rays all
+        use the same one. None without a sounding (csu_radartools then uses
+        its default).
+        """
+        if self.kwargs['freezing_level'] is not None:
+            return self.kwargs['freezing_level']
+        if self.hfrz is None and self.radar_T is not None:
+            self.hfrz = csu_liquid_ice_mass.get_freezing_altitude(
+                self.radar_T, self.radar_z/1000.0)
+        return self.hfrz
+
+    def get_fused_products(self, stages):
+        """
+        Computes the products of the given 'precip', 'dsd', and 'mass'
+        stages together, in one pass over blocks of fused_block_size gates
+        (whole rays), writing each block into preallocated outputs that are
+        then added to the radar object. Results match the separate
+        get_precip_rate(), get_dsd(), and get_liquid_and_frozen_mass()
+        calls, but temporary arrays are only as big as a block.
+        """
+        if 'precip' in stages and self.winter_flag:
+            print('Winter precip not enabled yet, sorry!')
+            stages = [stage for stage in stages if stage != 'precip']
+        nrays, ngates = self.radar.nrays, self.radar.ngates
+        size = max(1, int(self.kwargs['fused_block_size']) // ngates)
+        outputs = OrderedDict()
+        for start in range(0, nrays, size):
+            rays = slice(start, min(start + size, nrays))
+            results = OrderedDict()
+            if 'precip' in stages:
+                results.update(self.calc_precip_rate(
+                    rays, ice_flag=self.kwargs['ice_flag'],
+                    rain_method=self.kwargs['rain_method']))
+            if 'dsd' in stages:
+                results.update(self.calc_dsd(rays))
+            if 'mass' in stages:
+                results.update(self.calc_liquid_and_frozen_mass(rays))
+            for name in results:
+                block = np.ma.getdata(results[name])
+                if name not in outputs:
+                    outputs[name] = self.new_buffer((nrays, ngates),
+                                                    block.dtype)
+                outputs[name][rays] = block
+        self.add_products(outputs)
+
+    def add_products(self, results):
+        """Adds a dict of retrieved products to the radar object."""
+        for name in results:
+            units, long_name = PRODUCT_ATTRS[name]
+            self.add_field_to_radar_object(
+                results[name], field_name=name, units=units,
+                long_name=long_name, standard_name=long_name)
 
     def add_field_to_radar_object(self, field, field_name='FH',
                                   units='unitless', long_name='Hydrometeor ID',
                                   standard_name='Hydrometeor ID'):
         """
-        Adds a newly created field to the Py-ART radar object.
+        Adds a newly created field to the Py-ART radar object. The field
+        references the volume mask rather than copying it, and is stored as
+        set by the output_precision keyword.
         """
-        masked_field = np.ma.asanyarray(field)
-        fill_value = self.bad
-        if hasattr(self.radar.fields[self.name_dz]['data'], 'mask'):
-            setattr(masked_field, 'mask',
-                    self.radar.fields[self.name_dz]['data'].mask)
-            fill_value = self.radar.fields[self.name_dz]['_FillValue']
+        data, extra = self.format_output(np.ma.getdata(field), field_name)
+        fill_value = self.radar.fields[self.name_dz].get('_FillValue',
+                                                         self.bad)
+        mask = self.volume_mask.mask
+        if '_Write_as_dtype' in extra:
+            # Bad and out-of-range values can't be packed, so mask them
+            # (field owns its mask)
+            with np.errstate(invalid='ignore'):
+                bad = ~((data >= extra.pop('valid_min')) &
+                        (data <= extra.pop('valid_max')))
+            if bad.any():
+                mask = np.logical_or(mask, bad)
+        masked_field = np.ma.masked_array(data, mask=mask, copy=False)
         field_dict = {'data': masked_field,
                       'units': units,
                       'long_name': long_name,
                       'standard_name': standard_name,
                       '_FillValue': fill_value}
+        field_dict.update(extra)
         self.radar.add_field(field_name, field_dict, replace_existing=True)
 
+    def format_output(self, data, field_name):
+        """
+        Converts retrieved data to the dtype set by the output_precision
+        keyword. Returns the data and a dict of any extra field dictionary
+        entries (e.g., _FillValue, int16 packing attributes).
+        """
+        product = {self.name_fhc: 'FH', self.name_kd: 'KDP',
+                   self.name_fdp: 'FDP',
+                   self.name_sdp: 'SDP'}.get(field_name, field_name)
+        policy = self.output_precision
+        extra = {}
+        dtype = output_dtype(product, policy)
+        if data.dtype != np.uint8:  # uint8 (FH_CONF) is already compact
+            if dtype is None:
+                return data, extra
+            data = self.pooled(data, dtype)
+        if data.dtype == np.uint8:
+            extra['_FillValue'] = 255
+        if policy == 'packed' and product in PACKED_SCALES:
+            scale, offset = PACKED_SCALES[product]
+            extra = {'_Write_as_dtype': 'int16', 'scale_factor': scale,
+                     'add_offset': offset, '_FillValue': -32768,
+                     'valid_min': offset - 32767 * scale,
+                     'valid_max': offset + 32767 * scale}
+        return data, extra
+
     def interpolate_sounding_to_radar(self):
         """Takes sounding data and interpolates it to every radar gate."""
-        self.radar_z = get_z_from_radar(self.radar)
+        if getattr(self, 'radar_z', None) is not None:
+            pass  # Gate heights don't change if the sounding is redone
+        elif self.geometry_cache is not None:
+            self.radar_z = self.geometry_cache.get_z(self.radar)
+        else:
+            self.radar_z = get_z_from_radar(self.radar)
         self.radar_T = None
+        self.hfrz = None
         self.check_sounding_for_montonic()
         if self.T_flag:
-            shape = np.shape(self.radar_z)
-            rad_z1d = self.radar_z.ravel()
-            rad_T1d = np.interp(rad_z1d, self.snd_z, self.snd_T)
+            if self.geometry_cache is not None:
+                self.radar_T = self.geometry_cache.get_T(
+                    self.radar, self.snd_z, self.snd_T, self.radar_z)
+            else:
+                self.radar_T = interpolate_sounding_to_gates(
+                    self.radar_z, self.snd_z, self.snd_T)
             if self.verbose:
                 print('Trying to get radar_T')
-            self.radar_T = np.reshape(rad_T1d, shape)
 
     def check_sounding_for_montonic(self):
         """
@@ -553,20 +1705,30 @@ class DualPolRetrieval(object):
         monotonically so that z always increases. This eliminates data from
         descending balloons.
         """
-        dummy_z = []
-        dummy_T = []
         if hasattr(self, 'snd_T'):
-            if not self.snd_T.mask[0]:  # May cause issue for some soundings
-                dummy_z.append(self.snd_z[0])
-                dummy_T.append(self.snd_T[0])
-            for i, height in enumerate(self.snd_z):
-                if i > 0:
-                    if self.snd_z[i] > self.snd_z[i-1] and not\
-                       self.snd_T.mask[i]:
-                        dummy_z.append(self.snd_z[i])
-                        dummy_T.append(self.snd_T[i])
-            self.snd_z = np.array(dummy_z)
-            self.snd_T = np.array(dummy_T)
+            self.snd_z, self.snd_T = filter_monotonic_sounding(self.snd_z,
+                                                               self.snd_T)
+
+################################
+
+
+class Sounding(object):
+
+    """
+    A parsed sounding, filtered to be monotonic in height. Sounding objects
+    can be passed as the sounding keyword in place of a file name, so one
+    parse can be shared by many volumes (and pickled to worker processes).
+
+    Attributes
+    ----------
+    z = Heights (m MSL)
+    T = Temperatures (C)
+    time = Valid time (datetime) or None; needed for interpolate_soundings()
+    """
+
+    def __init__(self, z, T, time=None):
+        self.z, self.T = filter_monotonic_sounding(z, T)
+        self.time = time
 
 ################################
 
@@ -617,25 +1779,2591 @@ class HidColors(object):
 ################################
 
 
-def get_z_from_radar(radar):
-    """Input radar object, return z from radar (km, 2D)"""
-    azimuth_1D = radar.azimuth['data']
-    elevation_1D = radar.elevation['data']
-    srange_1D = radar.range['data']
-    sr_2d, az_2d = np.meshgrid(srange_1D, azimuth_1D)
-    el_2d = np.meshgrid(srange_1D, elevation_1D)[1]
-    xx, yy, zz = radar_coords_to_cart(sr_2d/RNG_MULT, az_2d, el_2d)
-    return zz + radar.altitude['data']
+class VolumeMask(object):
 
+    """
+    Gate mask for a whole radar volume (True = bad). The mask array is
+    referenced, never copied, by the reflectivity field and every field
+    DualPolRetrieval adds, so memory for masks does not grow with the number
+    of products. It starts as the reflectivity mask, QC adds to it, and
+    add()/remove() update it in place for all fields at once.
 
-def check_kwargs(kwargs, default_kw):
+    Sample interface
+    ----------------
+    retrieve = dualpol.DualPolRetrieval(radar, **kwargs)
+    retrieve.volume_mask.add(clutter_mask)
     """
-    Check user-provided kwargs against defaults, and if some defaults aren't
-    provided by user make sure they are provided to the function regardless.
+
+    def __init__(self, mask):
+        self.mask = np.array(mask, dtype=bool)
+
+    def add(self, mask):
+        """Masks additional gates (True = bad) in place."""
+        np.logical_or(self.mask, mask, out=self.mask)
+
+    def remove(self, mask):
+        """Unmasks gates (True = good) in place."""
+        np.logical_and(self.mask, np.logical_not(mask), out=self.mask)
+
+    def wrap(self, data, fill_value=None):
+        """Returns data as a masked array that references this mask."""
+        return np.ma.masked_array(np.ma.getdata(data), mask=self.mask,
+                                  copy=False, fill_value=fill_value)
+
+################################
+
+
+class BufferPool(object):
+
     """
-    for key in default_kw:
-        if key not in kwargs:
-            kwargs[key] = default_kw[key]
-    return kwargs
+    Pool of preallocated arrays, keyed by (shape, dtype), that retrieval
+    stages write their products into (buffer_pool keyword). When a
+    DualPolRetrieval is done with, release() puts its product arrays back
+    here for the next volume with the same scan shape, instead of freeing
+    them and allocating new ones, so a long-running service stops churning
+    (and fragmenting) memory. At most max_bytes of free arrays are kept.
+    Only arrays DualPolRetrieval allocates itself come from the pool (dtype
+    conversions for output_precision, fused and blocked HID outputs, and
+    block mode outputs); arrays CSU_RadarTools returns are kept as they are.
 
-#####################################
+    Sample interface
+    ----------------
+    pool = dualpol.BufferPool(max_bytes=2e9)
+    for filename in files:
+        retrieve = dualpol.DualPolRetrieval(filename, buffer_pool=pool,
+                                            **kwargs)
+        pyart.io.write_cfradial(filename + '.nc', retrieve.radar)
+        retrieve.release()
+    print(pool.stats())
+    """
+
+    def __init__(self, max_bytes=1e9):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._free = OrderedDict()  # (shape, dtype) -> list of arrays
+        self._free_bytes = 0
+        self._issued = weakref.WeakValueDictionary()  # id -> array in use
+        self.requests = 0
+        self.reuses = 0
+        self.returns = 0
+        self.discards = 0
+
+    def __getstate__(self):
+        # Arrays stay with the parent process
+        return {'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get(self, shape, dtype):
+        """
+        Returns an array (contents undefined) from the pool, or a new one.
+        """
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            self.requests += 1
+            arrays = self._free.get(key)
+            if arrays:
+                array = arrays.pop()
+                self._free_bytes -= array.nbytes
+                self.reuses += 1
+            else:
+                array = np.empty(shape, dtype=dtype)
+            self._issued[id(array)] = array
+        return array
+
+    def owns(self, array):
+        """Returns True if the array (or its base) is in use from the pool."""
+        root = _base_array(array)
+        return self._issued.get(id(root)) is root
+
+    def release(self, array):
+        """
+        Returns an array from get() (or a view of, or masked array around,
+        one) to the pool. It must not be used afterwards. Other arrays are
+        ignored. Returns True if the array went back to the pool.
+        """
+        root = _base_array(array)
+        with self._lock:
+            if self._issued.get(id(root)) is not root:
+                return False
+            del self._issued[id(root)]
+            self.returns += 1
+            key = (root.shape, root.dtype.str)
+            self._free.setdefault(key, []).append(root)
+            self._free_bytes += root.nbytes
+            # Drop the longest unused kinds of buffers first
+            self._free[key] = self._free.pop(key)
+            while self._free_bytes > self.max_bytes:
+                oldest = next(iter(self._free))
+                dropped = self._free[oldest].pop(0)
+                if not self._free[oldest]:
+                    del self._free[oldest]
+                self._free_bytes -= dropped.nbytes
+                self.discards += 1
+        return True
+
+    def clear(self):
+        """Drops all free arrays."""
+        with self._lock:
+            self._free = OrderedDict()
+            self._free_bytes = 0
+
+    def stats(self):
+        """
+        Returns a dict of occupancy (arrays and bytes in use and free) and
+        reuse (requests, requests met from the pool, reuse rate, arrays
+        returned, and free arrays discarded to stay under max_bytes).
+        """
+        with self._lock:
+            in_use = list(self._issued.values())
+            nfree = sum([len(arrays) for arrays in self._free.values()])
+            return {'in_use': len(in_use),
+                    'in_use_bytes': sum([array.nbytes for array in in_use]),
+                    'free': nfree, 'free_bytes': self._free_bytes,
+                    'requests': self.requests, 'reuses': self.reuses,
+                    'reuse_rate': (float(self.reuses) / self.requests
+                                   if self.requests else 0.0),
+                    'returns': self.returns, 'discards': self.discards}
+
+
+BUFFER_POOL = BufferPool()
+
+
+def _base_array(array):
+    """Returns the array that owns the memory of a view or masked array."""
+    array = np.ma.getdata(array)
+    while isinstance(array.base, np.ndarray):
+        array = array.base
+    return array
+
+################################
+
+
+class LazyFields(dict):
+
+    """
+    Radar fields dictionary used by DualPolRetrieval(lazy=True). Looking up
+    a product that has not been computed yet runs the retrieval stage that
+    produces it. Note that "in" and get() only see computed fields.
+    """
+
+    def __init__(self, fields, retrieve):
+        dict.__init__(self, fields)
+        self.retrieve = retrieve
+
+    def __missing__(self, key):
+        return self.retrieve.get_product(key)
+
+################################
+
+
+StageRecord = namedtuple('StageRecord', ['stage', 'wall', 'cpu', 'rss_delta',
+                                         'peak_bytes'])
+
+
+class Instrumentation(object):
+
+    """
+    Measures retrieval stages for DualPolRetrieval(instrument=...). Each
+    measured stage produces a StageRecord of wall time (s), CPU time (s),
+    growth in the process's peak RSS (bytes, None where the resource module
+    is unavailable), and peak bytes allocated by the stage (None unless
+    trace_memory is set). Records are passed to each of the callbacks and,
+    if a logger (logging.Logger or logger name) is given, logged at INFO.
+    trace_memory uses tracemalloc (Python 3 only), which slows down the
+    retrievals noticeably, so it is off by default.
+    One Instrumentation object may be shared by many retrievals.
+    """
+
+    def __init__(self, callbacks=None, logger=None, trace_memory=False):
+        self.callbacks = list(callbacks) if callbacks is not None else []
+        if isinstance(logger, str):
+            logger = logging.getLogger(logger)
+        self.logger = logger
+        self.trace_memory = trace_memory and tracemalloc is not None
+
+    def measure(self, stage, func, *args, **kwargs):
+        """
+        Calls func(*args, **kwargs) and returns (result, StageRecord).
+        """
+        tracing = False
+        if self.trace_memory:
+            tracing = not tracemalloc.is_tracing()
+            if tracing:
+                tracemalloc.start()
+            elif hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        rss = _peak_rss()
+        wall, cpu = time.time(), _cpu_time()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            wall, cpu = time.time() - wall, _cpu_time() - cpu
+            rss_delta = None if rss is None else _peak_rss() - rss
+            peak_bytes = None
+            if self.trace_memory:
+                peak_bytes = tracemalloc.get_traced_memory()[1] - base
+                if tracing:
+                    tracemalloc.stop()
+        record = StageRecord(stage, wall, cpu, rss_delta, peak_bytes)
+        for callback in self.callbacks:
+            callback(record)
+        if self.logger is not None:
+            self.logger.info('%s: wall %.4f s, cpu %.4f s, rss delta %s B, '
+                             'peak alloc %s B', *record)
+        return result, record
+
+################################
+
+
+class RetrievalConfig(object):
+
+    """
+    Frozen, validated set of DualPolRetrieval keywords. Unknown keywords and
+    invalid values raise ValueError here, once, rather than surfacing
+    volume by volume. Configs are hashable and compare equal when their
+    keywords do (see key), and compile() into a reusable ExecutionPlan, so
+    many volumes can run with no per-volume keyword handling. Treat values
+    (e.g., fhc_weights) as read-only; use replace() to derive a new config.
+
+    Sample interface
+    ----------------
+    config = dualpol.RetrievalConfig(dp='DP', sounding='snd.txt',
+                                     qc_flag=True)
+    plan = config.compile()
+    for filename in files:
+        retrieve = dualpol.DualPolRetrieval(filename, plan=plan)
+    """
+
+    def __init__(self, **kwargs):
+        unknown = sorted(set(kwargs) - set(DEFAULT_KW))
+        if unknown:
+            raise ValueError('Unknown DualPolRetrieval keyword(s): ' +
+                             ', '.join(unknown))
+        kw = copy.deepcopy(DEFAULT_KW)
+        for key in kwargs:
+            value = kwargs[key]
+            if isinstance(value, (dict, list)):
+                value = copy.deepcopy(value)
+            kw[key] = value
+        validate_kwargs(kw)
+        self.__dict__['kwargs'] = kw
+        self.__dict__['key'] = _kwargs_hash(kw)
+        self.__dict__['_plan'] = None
+
+    def __setattr__(self, name, value):
+        raise AttributeError('RetrievalConfig is frozen, use replace()')
+
+    def __getitem__(self, name):
+        return self.kwargs[name]
+
+    def __eq__(self, other):
+        return isinstance(other, RetrievalConfig) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return int(self.key[:15], 16)
+
+    def __repr__(self):
+        changed = []
+        for name in sorted(self.kwargs):
+            value = self.kwargs[name]
+            if not _same_value(value, DEFAULT_KW[name]):
+                text = repr(value)
+                if len(text) > 40:
+                    text = '<%s>' % type(value).__name__
+                changed.append('%s=%s' % (name, text))
+        return 'RetrievalConfig(' + ', '.join(changed) + ')'
+
+    def as_kwargs(self):
+        """Returns a copy of the complete keyword dict."""
+        return dict(self.kwargs)
+
+    def replace(self, **kwargs):
+        """Returns a new config with some keywords changed."""
+        return RetrievalConfig(**dict(self.kwargs, **kwargs))
+
+    def compile(self):
+        """Returns the ExecutionPlan for this config (made once)."""
+        if self._plan is None:
+            self.__dict__['_plan'] = ExecutionPlan(self)
+        return self._plan
+
+
+class ExecutionPlan(object):
+
+    """
+    What DualPolRetrieval does with a RetrievalConfig, worked out once
+    (see RetrievalConfig.compile()) and reused for any number of volumes.
+
+    Attributes
+    ----------
+    config = The RetrievalConfig
+    kwargs = Complete keywords, with geometry_cache, instrument, kdp_cache,
+             result_cache, and buffer_pool resolved to objects shared by
+             every volume
+    stages = Retrieval stages run up front, in order (dependencies run as
+             needed), or [] if lazy
+    inputs = Radar fields that must be present (dz, dr, rh)
+    optional_inputs = Fields used if present (kd, dp, ld); KDP is computed
+                      from dp if kd is not there
+    outputs = OrderedDict of the fields added, by stage order, to the dtype
+              they are stored as (None = as computed: float64, int for FH)
+    result_key = Hash of the keywords that affect products, used in
+                 ResultCache keys. A sounding file is hashed when the plan
+                 is made, so make a new plan if it changes.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        kwargs = resolve_kwarg_objects(config.as_kwargs())
+        self.kwargs = kwargs
+        self.stages = [] if kwargs['lazy'] else plan_stages(kwargs)
+        self.inputs = [kwargs['dz'], kwargs['dr'], kwargs['rh']]
+        self.optional_inputs = [kwargs[key] for key in ['kd', 'dp', 'ld']
+                                if kwargs[key] is not None]
+        self.outputs = OrderedDict()
+        method = kwargs['kdp_method']
+        products = OrderedDict([
+            ('kdp', [('FDP_' + method, 'FDP'), (kwargs['name_sdp'], 'SDP'),
+                     ('KDP_' + method, 'KDP')]),
+            ('fhc', [(kwargs['name_fhc'], 'FH')]),
+            ('precip', [('rain', 'rain'), ('method', 'method')]),
+            ('dsd', [('D0', 'D0'), ('NW', 'NW'), ('MU', 'MU')]),
+            ('mass', [('MW', 'MW'), ('MI', 'MI')])])
+        if kwargs['kd'] is not None:
+            products['kdp'] = []  # Unless kd is missing from the volume
+        if kwargs['fhc_confidence']:
+            products['fhc'].append(('FH_CONF', 'FH_CONF'))
+        if kwargs['ice_flag'] and kwargs['rain_method'] != 'hidro':
+            products['precip'] = [('ZDP', 'ZDP'), ('FI', 'FI')] + \
+                products['precip']
+        for stage in products:
+            if stage in self.stages:
+                for name, product in products[stage]:
+                    self.outputs[name] = output_dtype(
+                        product, kwargs['output_precision'])
+        self.result_key = _kwargs_hash(kwargs, RESULT_CACHE_IGNORED)
+
+################################
+
+
+class GeometryCache(object):
+
+    """
+    LRU cache of gate heights (radar_z) and sounding-interpolated gate
+    temperatures (radar_T). Heights are keyed on radar location, azimuth and
+    elevation angles quantized to angle_precision (deg), and range gates.
+    Temperatures are additionally keyed on a hash of the sounding. Volumes
+    repeating a scan geometry thus skip get_z_from_radar() and the sounding
+    interpolation. Cached arrays are shared and should be treated as
+    read-only.
+
+    Sample interface
+    ----------------
+    cache = dualpol.GeometryCache(maxsize=8, cache_dir='geom_cache')
+    for filename in files:
+        retrieve = dualpol.DualPolRetrieval(filename, geometry_cache=cache,
+                                            **kwargs)
+    print(cache.hits, cache.misses)
+    """
+
+    def __init__(self, maxsize=16, cache_dir=None, angle_precision=0.01):
+        """
+        Keywords
+        --------
+        maxsize = Maximum number of arrays held in memory
+        cache_dir = Optional directory for a persistent .npy store
+        angle_precision = Angles are rounded to this many degrees for keying
+        """
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.angle_precision = angle_precision
+        self.clear()
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def __getstate__(self):
+        # Contents and lock stay with the parent process
+        return {'maxsize': self.maxsize, 'cache_dir': self.cache_dir,
+                'angle_precision': self.angle_precision}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.clear()
+
+    def clear(self):
+        """Empties the in-memory cache and resets statistics."""
+        self._lock = threading.Lock()
+        self._arrays = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def geometry_key(self, radar):
+        """Returns the hash key describing a radar's scan geometry."""
+        hsh = hashlib.sha1()
+        for meta in [radar.latitude, radar.longitude, radar.altitude,
+                     radar.range]:
+            hsh.update(np.asarray(meta['data'], dtype='float64').tobytes())
+        for meta in [radar.azimuth, radar.elevation]:
+            angles = np.asarray(meta['data'], dtype='float64')
+            hsh.update(np.round(angles / self.angle_precision).astype(
+                'int64').tobytes())
+        return hsh.hexdigest()
+
+    def get_z(self, radar):
+        """Returns gate heights for the radar, computing them if needed."""
+        key = 'z_' + self.geometry_key(radar)
+        radar_z = self._get(key)
+        if radar_z is None:
+            radar_z = get_z_from_radar(radar)
+            self._put(key, radar_z)
+        return radar_z
+
+    def get_T(self, radar, snd_z, snd_T, radar_z=None):
+        """
+        Returns gate temperatures for the radar and a (monotonic) sounding,
+        interpolating if needed.
+        """
+        hsh = hashlib.sha1()
+        hsh.update(np.asarray(snd_z, dtype='float64').tobytes())
+        hsh.update(np.asarray(snd_T, dtype='float64').tobytes())
+        key = 'T_' + self.geometry_key(radar) + '_' + hsh.hexdigest()
+        radar_T = self._get(key)
+        if radar_T is None:
+            if radar_z is None:
+                radar_z = self.get_z(radar)
+            radar_T = interpolate_sounding_to_gates(radar_z, snd_z, snd_T)
+            self._put(key, radar_T)
+        return radar_T
+
+    def _get(self, key):
+        with self._lock:
+            if key in self._arrays:
+                self.hits += 1
+                array = self._arrays.pop(key)
+                self._arrays[key] = array
+                return array
+        array = None
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, key + '.npy')
+            if os.path.isfile(path):
+                try:
+                    array = np.load(path)
+                except (IOError, ValueError):
+                    array = None
+        with self._lock:
+            if array is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._store(key, array)
+        return array
+
+    def _put(self, key, array):
+        with self._lock:
+            self._store(key, array)
+        if self.cache_dir is not None:
+            _atomic_save(os.path.join(self.cache_dir, key + '.npy'), array)
+
+    def _store(self, key, array):
+        self._arrays[key] = array
+        while len(self._arrays) > self.maxsize:
+            self._arrays.popitem(last=False)
+
+
+GEOMETRY_CACHE = GeometryCache()
+
+# Parsed sounding files, keyed by (path, modification time)
+SOUNDING_CACHE_SIZE = 32
+_SOUNDING_CACHE = OrderedDict()
+_SOUNDING_LOCK = threading.Lock()
+
+################################
+
+
+class GridMapper(object):
+
+    """
+    Maps polar retrieval fields to a fixed Cartesian grid. For each scan
+    geometry, a sparse matrix of Cressman weights (gates within roi meters
+    of each grid point) and the nearest gate to each grid point are found
+    once, with a KD-tree, and cached (keyed like GeometryCache, plus the
+    grid). Each volume's fields are then gridded with one sparse matrix
+    product. Categorical fields (FH, method) take the nearest gate's value.
+
+    grid_shape = (nz, ny, nx) and grid_limits = ((zmin, zmax), (ymin, ymax),
+    (xmin, xmax)), in m from the radar, as in pyart.map.grid_from_radars().
+    With origin = (latitude, longitude[, altitude]), the limits are instead
+    relative to that point, so radars at different sites share the grid
+    (see contributions() and Mosaic).
+
+    Sample interface
+    ----------------
+    mapper = dualpol.GridMapper((1, 201, 201), ((1000, 1000),
+                                (-100000, 100000), (-100000, 100000)))
+    retrieve = dualpol.DualPolRetrieval(radar, grid=mapper, **kwargs)
+    rain = retrieve.grids['rain']
+    """
+
+    def __init__(self, grid_shape, grid_limits, roi=1000.0, maxsize=4,
+                 cache_dir=None, geometry_cache=None, origin=None):
+        """
+        Keywords
+        --------
+        roi = Radius of influence (m)
+        maxsize = Maximum number of scan geometries held in memory
+        cache_dir = Optional directory for a persistent .npz store
+        geometry_cache = GeometryCache whose geometry_key() (and angle
+                         precision) is used, default GEOMETRY_CACHE
+        origin = (latitude, longitude[, altitude (m)]) of the grid origin,
+                 default is each radar's own location
+        """
+        self.grid_shape = tuple(grid_shape)
+        self.grid_limits = tuple([tuple(lim) for lim in grid_limits])
+        self.roi = roi
+        if origin is not None:
+            origin = tuple(origin) + (0.0,) * (3 - len(origin))
+        self.origin = origin
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.geometry_cache = geometry_cache
+        self.clear()
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def __getstate__(self):
+        # Contents and lock stay with the parent process
+        state = dict(self.__dict__)
+        for key in ['_lock', '_weights', 'hits', 'misses']:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.clear()
+
+    def clear(self):
+        """Empties the in-memory cache and resets statistics."""
+        self._lock = threading.Lock()
+        self._weights = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def grid_points(self):
+        """Returns the z, y, x coordinates (m) of every grid point."""
+        axes = [np.linspace(lim[0], lim[1], n) for lim, n in
+                zip(self.grid_limits, self.grid_shape)]
+        return [a.ravel() for a in np.meshgrid(*axes, indexing='ij')]
+
+    def get_weights(self, radar):
+        """
+        Returns (weights, nearest) for a radar's scan geometry: a
+        (grid points x gates) scipy.sparse CSR matrix of Cressman weights,
+        and the flat index of the nearest gate to each grid point (-1 if
+        none is within roi). Built once per geometry.
+        """
+        cache = self.geometry_cache
+        if cache is None:
+            cache = GEOMETRY_CACHE
+        key = 'grid_' + hashlib.sha1((cache.geometry_key(radar) + repr(
+            (self.grid_shape, self.grid_limits, self.roi,
+             self.origin))).encode(
+            'ascii')).hexdigest()
+        with self._lock:
+            if key in self._weights:
+                self._weights[key] = self._weights.pop(key)
+                self.hits += 1
+                return self._weights[key]
+        path = None
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, key + '.npz')
+        if path is not None and os.path.exists(path):
+            stored = np.load(path)
+            weights = sparse.csr_matrix(
+                (stored['data'], stored['indices'], stored['indptr']),
+                shape=tuple(stored['shape']))
+            nearest = stored['nearest']
+        else:
+            weights, nearest = self.compute_weights(radar)
+            if path is not None:
+                _atomic_save(path, {'data': weights.data,
+                                    'indices': weights.indices,
+                                    'indptr': weights.indptr,
+                                    'shape': np.array(weights.shape),
+                                    'nearest': nearest})
+        with self._lock:
+            self.misses += 1
+            self._weights[key] = (weights, nearest)
+            while len(self._weights) > self.maxsize:
+                self._weights.popitem(last=False)
+        return weights, nearest
+
+    def compute_weights(self, radar):
+        """Finds grid weights and nearest gates with KD-trees."""
+        x, y, z = get_gate_xyz(radar)
+        if self.origin is not None:
+            dx, dy, dz = self.radar_offset(radar)
+            x, y, z = x + dx, y + dy, z + dz
+        gates = spatial.cKDTree(np.column_stack([z.ravel(), y.ravel(),
+                                                 x.ravel()]))
+        points = spatial.cKDTree(np.column_stack(self.grid_points()))
+        pairs = points.sparse_distance_matrix(gates, self.roi,
+                                              output_type='ndarray')
+        r2 = self.roi**2
+        d2 = pairs['v']**2
+        weights = sparse.csr_matrix(
+            ((r2 - d2) / (r2 + d2), (pairs['i'], pairs['j'])),
+            shape=(points.n, gates.n))
+        dist, nearest = gates.query(points.data, distance_upper_bound=self.roi)
+        nearest[~np.isfinite(dist)] = -1
+        return weights, nearest
+
+    def radar_offset(self, radar):
+        """Returns the radar's x, y, z (m) relative to origin."""
+        lat, lon, alt = self.origin
+        x, y = pyart.core.geographic_to_cartesian_aeqd(
+            radar.longitude['data'], radar.latitude['data'], lon, lat)
+        return (float(np.ravel(x)[0]), float(np.ravel(y)[0]),
+                float(np.ravel(radar.altitude['data'])[0]) - alt)
+
+    def contributions(self, radar, fields, categorical=CATEGORICAL_PRODUCTS):
+        """
+        Returns (cover, parts) for merging a radar's fields into a Mosaic.
+        cover is the flat index of the grid points within roi of any gate.
+        parts maps each named field to (value, weight) arrays over cover.
+        For continuous fields these are the weighted sum of the valid gates
+        and the sum of their weights. For categorical fields they are the
+        nearest gate's value and the point's total weight (0 if the value is
+        missing).
+        """
+        weights, nearest = self.get_weights(radar)
+        total = np.asarray(weights.sum(axis=1)).ravel()
+        cover = np.flatnonzero(total > 0)
+        rows = weights[cover]
+        near = nearest[cover]
+        parts = {}
+        for name in fields:
+            data, valid = self._flat_field(radar.fields[name])
+            if name in categorical:
+                good = near >= 0
+                value = np.zeros(len(cover), dtype=data.dtype)
+                value[good] = data[near[good]]
+                good[good] = valid[near[good]]
+                parts[name] = (value, np.where(good, total[cover], 0.0))
+            else:
+                parts[name] = (rows.dot(np.where(valid, data, 0.0)),
+                               rows.dot(valid.astype('float64')))
+        return cover, parts
+
+    def grid(self, radar, fields, categorical=CATEGORICAL_PRODUCTS):
+        """
+        Returns a dict of masked (nz, ny, nx) arrays for the named radar
+        fields. Fields named in categorical use the nearest gate's value.
+        Masked gates, and gates equal to a field's _FillValue, are left out.
+        """
+        weights, nearest = self.get_weights(radar)
+        names = [name for name in fields if name not in categorical]
+        grids = {}
+        if len(names) > 0:
+            columns = np.empty((radar.nrays * radar.ngates, 2 * len(names)))
+            for i, name in enumerate(names):
+                data, valid = self._flat_field(radar.fields[name])
+                columns[:, 2*i] = np.where(valid, data, 0.0)
+                columns[:, 2*i+1] = valid
+            sums = weights.dot(columns)
+            for i, name in enumerate(names):
+                norm = sums[:, 2*i+1]
+                grid = sums[:, 2*i] / np.where(norm > 0, norm, 1.0)
+                grids[name] = np.ma.masked_array(
+                    grid, mask=norm <= 0).reshape(self.grid_shape)
+        for name in fields:
+            if name in categorical:
+                data, valid = self._flat_field(radar.fields[name])
+                good = nearest >= 0
+                grid = np.zeros(nearest.shape, dtype=data.dtype)
+                grid[good] = data[nearest[good]]
+                mask = ~good
+                mask[good] = ~valid[nearest[good]]
+                grids[name] = np.ma.masked_array(
+                    grid, mask=mask).reshape(self.grid_shape)
+        return grids
+
+    def _flat_field(self, field):
+        data = field['data']
+        valid = ~np.ma.getmaskarray(data).ravel()
+        data = np.ma.getdata(data).ravel()
+        if '_FillValue' in field:
+            valid &= data != field['_FillValue']
+        return data, valid
+
+
+class Mosaic(object):
+
+    """
+    Multi-radar mosaic of retrieval fields on a common grid (see
+    GridMapper with origin). Each site's latest contributions() are kept,
+    and when a site updates only the tiles (tile_shape blocks of grid
+    columns) its coverage touches are merged again, from every site
+    covering them. Continuous fields are the weighted mean over all sites'
+    gates within roi. Categorical fields (FH, method) take the value from
+    the site with the most weight at each point.
+
+    Sample interface
+    ----------------
+    mapper = dualpol.GridMapper((1, 501, 501), ((1000, 1000),
+                                (-250000, 250000), (-250000, 250000)),
+                                origin=(35.2, -97.4))
+    mosaic = dualpol.Mosaic(mapper.grid_shape, tile_shape=(50, 50))
+    for site, radar in volumes:
+        mosaic.update(site, *mapper.contributions(radar, ['rain', 'FH']))
+    rain = mosaic.grids['rain']
+    """
+
+    def __init__(self, grid_shape, tile_shape=(64, 64),
+                 categorical=CATEGORICAL_PRODUCTS):
+        self.grid_shape = tuple(grid_shape)
+        self.tile_shape = tuple(tile_shape)
+        self.categorical = categorical
+        nz, ny, nx = self.grid_shape
+        ntx = -(-nx // self.tile_shape[1])
+        tiles = (np.arange(ny) // self.tile_shape[0])[:, np.newaxis] * ntx + \
+            np.arange(nx) // self.tile_shape[1]
+        self.tile_of = np.broadcast_to(tiles, self.grid_shape).ravel()
+        self.ntiles = int(tiles.max()) + 1
+        # Grid points of tile i are _order[_bounds[i]:_bounds[i+1]]
+        self._order = np.argsort(self.tile_of, kind='mergesort')
+        self._bounds = np.searchsorted(self.tile_of[self._order],
+                                       np.arange(self.ntiles + 1))
+        self.sites = OrderedDict()
+        self.grids = {}
+        self.tiles_merged = 0
+
+    def update(self, site, cover, parts, time=None):
+        """
+        Replaces a site's contributions (from GridMapper.contributions())
+        and merges the affected tiles. Returns the indices of the tiles
+        merged.
+        """
+        tiles = np.unique(self.tile_of[cover])
+        merge = tiles
+        if site in self.sites:
+            merge = np.union1d(tiles, self.sites[site]['tiles'])
+        self.sites[site] = {'cover': cover, 'tiles': tiles, 'parts': parts,
+                            'time': time}
+        self.merge(merge)
+        return merge
+
+    def remove(self, site):
+        """Drops a site from the mosaic (e.g., when it goes offline)."""
+        if site in self.sites:
+            self.merge(self.sites.pop(site)['tiles'])
+
+    def merge(self, tiles):
+        """Recomputes the given tiles of every field from all sites."""
+        if len(tiles) == 0:
+            return
+        points = np.sort(np.concatenate(
+            [self._order[self._bounds[i]:self._bounds[i+1]] for i in tiles]))
+        sites = [state for state in self.sites.values()
+                 if len(np.intersect1d(state['tiles'], tiles)) > 0]
+        for name in set(name for state in self.sites.values()
+                        for name in state['parts']):
+            value = np.zeros(len(points))
+            weight = np.zeros(len(points))
+            for state in sites:
+                if name not in state['parts']:
+                    continue
+                # Where the site's cover falls among points
+                index = np.searchsorted(points, state['cover'])
+                inside = index < len(points)
+                inside[inside] = points[index[inside]] == \
+                    state['cover'][inside]
+                index = index[inside]
+                site_value, site_weight = state['parts'][name]
+                if name in self.categorical:
+                    better = site_weight[inside] > weight[index]
+                    value[index[better]] = site_value[inside][better]
+                    weight[index[better]] = site_weight[inside][better]
+                else:
+                    value[index] += site_value[inside]
+                    weight[index] += site_weight[inside]
+            if name not in self.categorical:
+                value /= np.where(weight > 0, weight, 1.0)
+            if name not in self.grids:
+                dtype = [state['parts'][name][0].dtype for state in
+                         self.sites.values() if name in state['parts']][0]
+                self.grids[name] = np.ma.masked_array(
+                    np.zeros(self.grid_shape, dtype=dtype),
+                    mask=np.ones(self.grid_shape, dtype=bool))
+            grid = self.grids[name]
+            np.put(grid.data, points, value)
+            np.put(grid.mask, points, weight <= 0)
+        self.tiles_merged += len(tiles)
+
+################################
+
+
+Accumulation = namedtuple('Accumulation', ['start', 'end', 'total', 'hours'])
+
+
+class RainAccumulator(object):
+
+    """
+    Streaming rainfall accumulator. Successive volumes (DualPolRetrieval
+    objects, Py-ART radar objects with a rain field, or file names) are
+    averaged onto a fixed grid, and rain rates are integrated over time
+    between scans (trapezoidal rule) into running totals (mm). Memory use is
+    constant: only the totals, the hours of coverage, and the last volume's
+    gridded rain rate are kept.
+
+    The grid is polar (nazimuth azimuth bins by the first volume's range
+    gates) unless grid_shape=(ny, nx) and grid_limits=((ymin, ymax),
+    (xmin, xmax)) (m from the radar) are given for a Cartesian grid. Only
+    the given sweep (lowest by default) is used. Grid cells no gate falls in
+    are unobserved, and the last/next observed rate is held across them.
+
+    Keywords
+    --------
+    period = Accumulation period (s), e.g. 3600 for hourly totals. Totals
+             are split at period boundaries (multiples of period since
+             1970-01-01) and returned by add() as Accumulation tuples.
+             None (default) keeps one running total (see running()).
+    max_gap = Time (s) between scans beyond which the interval is not
+              accumulated (counted in self.gaps). None means no limit.
+    checkpoint = .npz file the state is saved to after each volume, for
+                 resuming with RainAccumulator.load().
+    release = Set to False to keep the rain field in each radar object once
+              it has been added.
+    retrieval_kw = DualPolRetrieval keywords used for file names.
+
+    Sample interface
+    ----------------
+    acc = dualpol.RainAccumulator(period=3600, checkpoint='rain.npz',
+                                  retrieval_kw={'dp': 'DP'})
+    for filename in sorted(glob.glob('/data/*.nc')):
+        for hour in acc.add(filename):
+            np.save(hour.end.strftime('rain_%Y%m%d%H.npy'), hour.total)
+    """
+
+    def __init__(self, grid_shape=None, grid_limits=None, nazimuth=360,
+                 sweep=0, period=None, max_gap=None, checkpoint=None,
+                 field='rain', release=True, retrieval_kw=None):
+        self.grid_shape = tuple(grid_shape) if grid_shape is not None \
+            else None
+        self.grid_limits = grid_limits
+        self.nazimuth = nazimuth
+        self.sweep = sweep
+        self.period = period
+        self.max_gap = max_gap
+        self.checkpoint = checkpoint
+        self.field = field
+        self.release = release
+        self.retrieval_kw = retrieval_kw if retrieval_kw is not None else {}
+        self.range = None
+        self.shape = self.grid_shape
+        self.total = None
+        self.hours = None
+        self.last_rate = None
+        self.last_time = None
+        self.period_start = None
+        self.volumes = 0
+        self.gaps = 0
+
+    def add(self, volume, time=None):
+        """
+        Adds a volume's rain rates to the running totals. time (datetime)
+        defaults to the volume start time. Returns a list of the
+        Accumulation tuples for periods completed by this volume.
+        """
+        if isinstance(volume, str):
+            volume = DualPolRetrieval(volume, **dict(self.retrieval_kw,
+                                                     lazy=True))
+        if isinstance(volume, DualPolRetrieval):
+            if not volume.success:
+                warnings.warn('Retrieval failed, volume not accumulated')
+                return []
+            radar = volume.radar
+        else:
+            radar = volume
+        if time is None:
+            time = get_radar_time(radar)
+        t = _epoch_seconds(time)
+        if self.last_time is not None and t <= self.last_time:
+            warnings.warn('Volume is not after the last one added, skipping')
+            return []
+        rate = self.grid_rate(radar)
+        if self.release:
+            dict.pop(radar.fields, self.field, None)
+        done = []
+        if self.last_time is None:
+            self.total = np.zeros(self.shape)
+            self.hours = np.zeros(self.shape)
+            self.period_start = t if self.period is None else \
+                np.floor(t / self.period) * self.period
+        else:
+            gap = (self.max_gap is not None and
+                   t - self.last_time > self.max_gap)
+            if gap:
+                self.gaps += 1
+            t0, r0 = self.last_time, self.last_rate
+            while self.period is not None and \
+                    t >= self.period_start + self.period:
+                bound = self.period_start + self.period
+                rb = r0 + (rate - r0) * ((bound - t0) / (t - t0))
+                if not gap:
+                    self.integrate(t0, r0, bound, rb)
+                done.append(self.running(end=bound))
+                self.total = np.zeros(self.shape)
+                self.hours = np.zeros(self.shape)
+                self.period_start = bound
+                t0, r0 = bound, rb
+            if not gap:
+                self.integrate(t0, r0, t, rate)
+        self.last_time, self.last_rate = t, rate
+        self.volumes += 1
+        if self.checkpoint is not None:
+            self.save(self.checkpoint)
+        return done
+
+    def integrate(self, t0, r0, t1, r1):
+        """Adds the rain between times t0 and t1 (s) with rates r0 and r1."""
+        hrs = (t1 - t0) / 3600.0
+        rate = np.where(np.isnan(r0), r1,
+                        np.where(np.isnan(r1), r0, 0.5 * (r0 + r1)))
+        valid = np.isfinite(rate)
+        self.total += np.where(valid, rate, 0.0) * hrs
+        self.hours += valid * hrs
+
+    def running(self, end=None):
+        """
+        Returns an Accumulation of the current (partial) period, from its
+        start to end (s since 1970, default the last volume's time).
+        """
+        if end is None:
+            end = self.last_time
+        return Accumulation(_from_epoch_seconds(self.period_start),
+                            _from_epoch_seconds(end), self.total, self.hours)
+
+    def grid_rate(self, radar):
+        """
+        Returns the mean rain rate (mm/h) in each grid cell for a radar
+        volume, NaN in cells without gates. Masked gates count as no rain.
+        """
+        start = radar.sweep_start_ray_index['data'][self.sweep]
+        end = radar.sweep_end_ray_index['data'][self.sweep]
+        rain = np.ma.filled(radar.fields[self.field]['data'][start:end+1],
+                            0.0).astype(float)
+        rain[~(rain > 0)] = 0.0
+        index = self.grid_index(radar, slice(start, end+1))
+        good = index >= 0
+        ncell = int(np.prod(self.shape))
+        count = np.bincount(index[good], minlength=ncell)
+        sums = np.bincount(index[good], weights=rain[good], minlength=ncell)
+        rate = np.zeros(ncell) + np.nan
+        rate[count > 0] = sums[count > 0] / count[count > 0]
+        return rate.reshape(self.shape)
+
+    def grid_index(self, radar, rays):
+        """
+        Returns the flat grid cell index of each gate in rays (a slice of
+        the volume), -1 for gates off the grid.
+        """
+        if self.grid_shape is not None:
+            x, y, z = radar.get_gate_x_y_z(self.sweep)
+            (ymin, ymax), (xmin, xmax) = self.grid_limits
+            ny, nx = self.grid_shape
+            ix = np.floor((x - xmin) * nx / (xmax - xmin)).astype(int)
+            iy = np.floor((y - ymin) * ny / (ymax - ymin)).astype(int)
+            index = iy * nx + ix
+            index[(ix < 0) | (ix >= nx) | (iy < 0) | (iy >= ny)] = -1
+            return index
+        if self.range is None:
+            self.range = np.array(radar.range['data'], dtype=float)
+            self.shape = (self.nazimuth, len(self.range))
+        ngates = len(self.range)
+        spacing = self.range[1] - self.range[0] if ngates > 1 else 1.0
+        gates = np.round((radar.range['data'] - self.range[0]) /
+                         spacing).astype(int)
+        az = radar.azimuth['data'][rays]
+        azbin = np.round(az * self.nazimuth / 360.0).astype(int) % \
+            self.nazimuth
+        index = azbin[:, np.newaxis] * ngates + gates[np.newaxis, :]
+        index[:, (gates < 0) | (gates >= ngates)] = -1
+        return index
+
+    def save(self, path):
+        """Saves the accumulator state to a .npz file (atomically)."""
+        config = {'grid_shape': self.grid_shape,
+                  'grid_limits': self.grid_limits, 'nazimuth': self.nazimuth,
+                  'sweep': self.sweep, 'period': self.period,
+                  'max_gap': self.max_gap, 'field': self.field}
+        state = {'config': np.array(json.dumps(config)),
+                 'counts': np.array([self.volumes, self.gaps]),
+                 'times': np.array([np.nan, np.nan])}
+        if self.last_time is not None:
+            state['times'] = np.array([self.last_time, self.period_start])
+            for name in ['range', 'total', 'hours', 'last_rate']:
+                if getattr(self, name) is not None:
+                    state[name] = getattr(self, name)
+        _atomic_save(path, state)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """
+        Returns a RainAccumulator resumed from a file written by save().
+        kwargs are passed on (e.g., checkpoint, release, retrieval_kw).
+        """
+        state = np.load(path)
+        config = json.loads(str(state['config']))
+        config.update(kwargs)
+        acc = cls(**config)
+        acc.volumes, acc.gaps = [int(x) for x in state['counts']]
+        if np.isfinite(state['times'][0]):
+            acc.last_time, acc.period_start = [float(x) for x in
+                                               state['times']]
+            for name in ['range', 'total', 'hours', 'last_rate']:
+                if name in state.files:
+                    setattr(acc, name, state[name])
+            acc.shape = acc.total.shape
+        return acc
+
+################################
+
+
+class _DiskCache(object):
+
+    """
+    Directory of .npz entries shared by any number of processes, trimmed to
+    max_bytes (and max_entries, if set) by removing the least recently used.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1e9, max_entries=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:  # Made by another process meanwhile
+                pass
+
+    def entries(self):
+        """Returns (mtime, bytes, file name) of each entry."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz') and '.tmp' not in name:
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        return entries
+
+    def evict(self):
+        """Removes least recently used entries until within limits."""
+        entries = self.entries()
+        total = sum([entry[1] for entry in entries])
+        count = len(entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes and (self.max_entries is None or
+                                            count <= self.max_entries):
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                self.evictions += 1
+            except OSError:
+                pass  # Removed by another process
+            total -= size
+            count -= 1
+
+    def size(self):
+        """Returns the total size (bytes) of the cached entries."""
+        return sum([entry[1] for entry in self.entries()])
+
+
+class KdpCache(_DiskCache):
+
+    """
+    Persistent, content-addressed cache of KDP, FDP, and SDP. Entries are
+    keyed by a hash of the differential phase and reflectivity data plus
+    gs, thresh_sdp, kdp_window, bad, and kdp_method, so a volume retrieved
+    again (e.g., with other HID or rain settings) skips the KDP calculation.
+    Entries are .npz files written atomically, so any number of processes
+    may share a cache_dir. Once the files exceed max_bytes, the least
+    recently used ones are removed.
+
+    Sample interface
+    ----------------
+    cache = dualpol.KdpCache('kdp_cache', max_bytes=2e9)
+    retrieve = dualpol.DualPolRetrieval(radar, kdp_cache=cache, **kwargs)
+    print(cache.hits, cache.misses)
+    """
+
+    def key(self, dp, dz, **params):
+        """Returns the hash key for input arrays and KDP parameters."""
+        hsh = hashlib.sha1()
+        for array in [dp, dz]:
+            array = np.ascontiguousarray(array)
+            hsh.update(repr((array.dtype.str, array.shape)).encode('ascii'))
+            hsh.update(array.tobytes())
+        hsh.update(repr(sorted(params.items())).encode('ascii'))
+        return hsh.hexdigest()
+
+    def get(self, key):
+        """Returns (kdp, fdp, sdp) for a key, or None if not cached."""
+        path = os.path.join(self.cache_dir, key + '.npz')
+        try:
+            with np.load(path) as stored:
+                result = stored['kdp'], stored['fdp'], stored['sdp']
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, KeyError):
+            # Missing, evicted by another process meanwhile, or unreadable
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, key, kdp, fdp, sdp):
+        """Stores (kdp, fdp, sdp) under a key, then enforces max_bytes."""
+        _atomic_save(os.path.join(self.cache_dir, key + '.npz'),
+                     {'kdp': kdp, 'fdp': fdp, 'sdp': sdp})
+        self.evict()
+
+
+# DualPolRetrieval keywords that don't change the retrieved products, so
+# are left out of ResultCache keys
+RESULT_CACHE_IGNORED = ['verbose', 'sweep_workers', 'sweep_pool',
+                        'geometry_cache', 'block_size', 'lazy', 'instrument',
+                        'grid', 'grid_fields', 'kdp_cache', 'kdp_workers',
+                        'kdp_pool', 'kdp_chunk_size', 'fused',
+                        'fused_block_size', 'fhc_block_size', 'result_cache',
+                        'buffer_pool']
+
+
+class ResultCache(_DiskCache):
+
+    """
+    Persistent cache of finished retrievals (result_cache keyword). Entries
+    are keyed by a hash of the input fields, the scan (location, angles,
+    range, and time), and every DualPolRetrieval keyword that affects the
+    products (see RESULT_CACHE_IGNORED), with sounding files and Sounding
+    objects hashed by content. A volume retrieved again with the same
+    settings, e.g., when a job is rerun, then just loads its products.
+    Entries hold the new fields and the volume mask (bit-packed) in a
+    compressed .npz file, written atomically so processes can share a
+    cache_dir. Once over max_bytes or max_entries, the least recently used
+    entries are removed.
+
+    Sample interface
+    ----------------
+    cache = dualpol.ResultCache('result_cache', max_bytes=20e9)
+    for filename in files:
+        retrieve = dualpol.DualPolRetrieval(filename, result_cache=cache,
+                                            **kwargs)
+    print(cache.stats())
+    """
+
+    def __init__(self, cache_dir, max_bytes=1e9, max_entries=None,
+                 compress=True):
+        """
+        Keywords
+        --------
+        max_bytes = Total size of entries kept (bytes)
+        max_entries = Number of entries kept (default no limit)
+        compress = Set to False to store entries uncompressed (faster to
+                   write and read, but larger)
+        """
+        _DiskCache.__init__(self, cache_dir, max_bytes=max_bytes,
+                            max_entries=max_entries)
+        self.compress = compress
+
+    def key(self, radar, kwargs, kwargs_key=None):
+        """
+        Returns the hash key for a radar object's input fields (those named
+        by the dz, dr, rh, dp, kd, and ld keywords) and scan, and the
+        effective DualPolRetrieval keywords. kwargs_key is the keywords'
+        hash if already known (ExecutionPlan.result_key).
+        """
+        hsh = hashlib.sha1()
+        for name in ['dz', 'dr', 'rh', 'dp', 'kd', 'ld']:
+            if kwargs[name] is not None and kwargs[name] in radar.fields:
+                _update_hash(hsh, radar.fields[kwargs[name]]['data'])
+        for meta in [radar.latitude, radar.longitude, radar.altitude,
+                     radar.range, radar.azimuth, radar.elevation, radar.time,
+                     radar.sweep_start_ray_index, radar.sweep_end_ray_index]:
+            _update_hash(hsh, np.asarray(meta['data']))
+        _update_hash(hsh, radar.time.get('units'))
+        if kwargs_key is None:
+            kwargs_key = _kwargs_hash(kwargs, RESULT_CACHE_IGNORED)
+        hsh.update(kwargs_key.encode('ascii'))
+        return hsh.hexdigest()
+
+    def get(self, key):
+        """
+        Returns (meta, arrays) stored under a key, or None if not cached.
+        meta is a dict describing the fields, arrays a dict of arrays.
+        """
+        path = os.path.join(self.cache_dir, key + '.npz')
+        try:
+            with np.load(path) as stored:
+                arrays = dict([(name, stored[name]) for name in stored.files])
+            meta = json.loads(str(arrays.pop('meta')))
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, KeyError):
+            # Missing, evicted by another process meanwhile, or unreadable
+            self.misses += 1
+            return None
+        self.hits += 1
+        return meta, arrays
+
+    def put(self, key, meta, arrays):
+        """Stores meta and arrays under a key, then enforces the limits."""
+        arrays = dict(arrays)
+        arrays['meta'] = np.array(json.dumps(meta, default=_json_default))
+        _atomic_save(os.path.join(self.cache_dir, key + '.npz'), arrays,
+                     compress=self.compress)
+        self.evict()
+
+    def stats(self):
+        """
+        Returns a dict of hits, misses, and evictions by this object, and
+        the number and total size (bytes) of entries in the cache.
+        """
+        entries = self.entries()
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(entries),
+                'bytes': sum([entry[1] for entry in entries])}
+
+################################
+
+
+class ProductStore(object):
+
+    """
+    Directory store of retrieved products from many volumes, written
+    straight into memory-mapped .npy files rather than through Py-ART's
+    radar writers (which would rewrite the input fields too). Each volume
+    gets a subdirectory holding one .npy file per product and one for the
+    shared volume mask (fields with masks of their own, like packed ones,
+    get a separate mask file). index.json lists the volumes, their sweeps,
+    and field metadata. Reads are memory-mapped, so loading one field or one
+    sweep does not read the rest of the store.
+
+    Sample interface
+    ----------------
+    store = dualpol.ProductStore('products')
+    for filename in files:
+        store.append(dualpol.DualPolRetrieval(filename, **kwargs))
+    rain = store.read(-1, 'rain', sweep=0)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        index = os.path.join(path, 'index.json')
+        if os.path.exists(index):
+            with open(index) as f:
+                self.volumes = json.load(f)['volumes']
+        else:
+            self.volumes = []
+
+    def __len__(self):
+        return len(self.volumes)
+
+    def append(self, volume, fields=None, time=None):
+        """
+        Writes the products of a DualPolRetrieval (or the named fields of a
+        Py-ART radar object) as a new volume. time (datetime) defaults to
+        the volume start time. Returns the new volume's index.
+        """
+        if isinstance(volume, DualPolRetrieval):
+            radar = volume.radar
+            mask = volume.volume_mask.mask
+            if fields is None:
+                fields = [name for name in volume.product_stages()
+                          if dict.__contains__(radar.fields, name)]
+        else:
+            radar = volume
+            mask = None
+            if fields is None:
+                raise ValueError('fields needed to store a radar object')
+        if time is None:
+            time = get_radar_time(radar)
+        with self._lock:
+            name = 'volume_%06d' % len(self.volumes)
+            self.volumes.append(None)
+        os.makedirs(os.path.join(self.path, name))
+        entry = {'name': name, 'time': time.isoformat(),
+                 'shape': [radar.nrays, radar.ngates], 'fields': {},
+                 'sweeps': [[int(i), int(j)] for i, j in zip(
+                     radar.sweep_start_ray_index['data'],
+                     radar.sweep_end_ray_index['data'])]}
+        for field in fields:
+            data = dict.__getitem__(radar.fields, field)['data']
+            meta = {}
+            for key, value in dict.__getitem__(radar.fields, field).items():
+                if key != 'data' and np.ndim(value) == 0 and \
+                   isinstance(np.asarray(value).item(),
+                              (str, int, float, bool)):
+                    meta[key] = np.asarray(value).item()
+            meta['dtype'] = np.dtype(data.dtype).str
+            field_mask = np.ma.getmaskarray(data)
+            if mask is None or not np.array_equal(field_mask, mask):
+                meta['mask'] = field + '_mask'
+                self._write(name, meta['mask'], field_mask)
+            else:
+                meta['mask'] = 'mask'
+            self._write(name, field, np.ma.getdata(data))
+            entry['fields'][field] = meta
+        if mask is not None:
+            self._write(name, 'mask', mask)
+        with self._lock:
+            self.volumes[int(name[7:])] = entry
+            self._write_index()
+        return int(name[7:])
+
+    def read(self, volume, field, sweep=None):
+        """
+        Returns a memory-mapped, masked (rays x gates) array of one field
+        from one volume (index, negative indices count from the end), or
+        only from one sweep. Nothing else is read from disk.
+        """
+        entry = self.volumes[volume]
+        meta = entry['fields'][field]
+        rays = slice(None)
+        if sweep is not None:
+            start, end = entry['sweeps'][sweep]
+            rays = slice(start, end + 1)
+        data = self._open(entry['name'], field)[rays]
+        mask = self._open(entry['name'], meta['mask'])[rays]
+        return np.ma.masked_array(data, mask=mask, copy=False)
+
+    def field_dict(self, volume, field, sweep=None):
+        """Returns a Py-ART field dictionary (see read()) with metadata."""
+        meta = dict(self.volumes[volume]['fields'][field])
+        for key in ['dtype', 'mask']:
+            meta.pop(key)
+        meta['data'] = self.read(volume, field, sweep=sweep)
+        return meta
+
+    def _write(self, volume, name, array):
+        out = np.lib.format.open_memmap(
+            os.path.join(self.path, volume, name + '.npy'), mode='w+',
+            dtype=array.dtype, shape=array.shape)
+        out[:] = array
+        out.flush()
+        del out
+
+    def _open(self, volume, name):
+        return np.load(os.path.join(self.path, volume, name + '.npy'),
+                       mmap_mode='r')
+
+    def _write_index(self):
+        path = os.path.join(self.path, 'index.json')
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'version': VERSION, 'volumes': [
+                entry for entry in self.volumes if entry is not None]}, f,
+                indent=1)
+        _replace(tmp, path)
+
+################################
+
+
+def _csu_kdp_backend(dp, dz, rng, gs=150.0, thresh_sdp=DEFAULT_SDP, bad=BAD,
+                     window=3.0):
+    """KDP backend for kdp_method='CSU' (csu_kdp.calc_kdp_bringi)"""
+    # A real (C-contiguous) array, as csu_kdp copies rng keeping its memory
+    # layout and its compiled ray loop reads each row as contiguous
+    rng = np.ascontiguousarray(np.broadcast_to(rng, np.shape(dp)))
+    return csu_kdp.calc_kdp_bringi(
+        dp=dp, dz=dz, rng=rng, gs=gs, thsd=thresh_sdp, bad=bad,
+        window=window)
+
+
+# KDP algorithms by (upper case) kdp_method, see register_kdp_backend()
+KDP_BACKENDS = {'CSU': _csu_kdp_backend}
+
+
+def register_kdp_backend(name, function):
+    """
+    Makes a KDP algorithm available as kdp_method=name. It is called as
+    function(dp, dz, rng, gs=, thresh_sdp=, bad=, window=) with (rays x
+    gates) differential phase (deg) and reflectivity (dBZ) arrays, where bad
+    gates are set to bad, and 1D range (km). It must return (rays x gates)
+    KDP, filtered differential phase, and standard deviation of
+    differential phase arrays. Rays are processed independently, so any
+    subset of rays may be passed. With a process pool (kdp_workers), the
+    function must be registered at import time of a module the workers
+    import.
+    """
+    KDP_BACKENDS[name.upper()] = function
+
+
+def run_kdp_backend(dp, dz, rng, method='CSU', workers=None, pool='process',
+                    chunk_size=None, **params):
+    """
+    Runs a KDP backend on all rays, in chunks of rays spread over a pool
+    of workers if workers is set. Returns ((kdp, fdp, sdp), timing) where
+    timing is a dict with rays, elapsed time, and rays per second.
+    """
+    function = KDP_BACKENDS[method.upper()]
+    start = time.time()
+    nrays = np.shape(dp)[0]
+    if workers is None:
+        workers = 1
+        result = function(dp, dz, rng, **params)
+    else:
+        workers = max(1, int(workers))
+        if chunk_size is None:
+            chunk_size = int(np.ceil(nrays / (4.0 * workers)))
+        chunk_size = max(1, int(chunk_size))
+        tasks = [(method, dp[i:i+chunk_size], dz[i:i+chunk_size], rng, params)
+                 for i in range(0, nrays, chunk_size)]
+        if pool == 'process':
+            pool = multiprocessing.Pool(workers)
+        else:
+            pool = ThreadPool(workers)
+        try:
+            chunks = pool.map(_kdp_chunk_worker, tasks)
+        finally:
+            pool.terminate()
+            pool.join()
+        result = tuple([np.concatenate([chunk[i] for chunk in chunks])
+                        for i in range(3)])
+    elapsed = time.time() - start
+    timing = {'method': method, 'workers': workers, 'rays': nrays,
+              'elapsed': elapsed,
+              'rays_per_sec': nrays / elapsed if elapsed > 0 else np.inf}
+    return result, timing
+
+
+def _kdp_chunk_worker(task):
+    method, dp, dz, rng, params = task
+    return KDP_BACKENDS[method.upper()](dp, dz, rng, **params)
+
+################################
+
+
+def _block_worker(task):
+    """
+    Runs DualPolRetrieval on one block of rays for retrieve_by_blocks().
+    Returns the success flag, a dict of new (or QC-modified) fields,
+    elapsed time, and CPU time used by the worker's thread.
+    """
+    radar, inputs, kwargs = task
+    start, cpu = time.time(), _thread_cpu_time()
+    retrieve = DualPolRetrieval(radar, **dict(kwargs))
+    fields = {}
+    if retrieve.success:
+        radar = retrieve.radar  # Trimmed if kwargs has range_limits
+        for name in radar.fields:
+            if name not in inputs or (kwargs['qc_flag'] and
+                                      name == kwargs['dz']):
+                fields[name] = radar.fields[name]
+    return retrieve.success, fields, time.time() - start, \
+        _thread_cpu_time() - cpu
+
+
+def _subset_radar(radar, rays=None, gates=None, fields=None):
+    """
+    Returns a shallow copy of a Py-ART radar object restricted to the given
+    rays and gates, with sweep metadata adjusted to match. rays and gates
+    can be slices, in which case field data are views of the original
+    arrays, or sorted index arrays. Only the named fields (default all) are
+    kept.
+    """
+    if rays is None:
+        rays = slice(None)
+    if gates is None:
+        gates = slice(None)
+    ray_index = np.arange(radar.nrays)[rays]
+    sweep_index = np.searchsorted(radar.sweep_end_ray_index['data'],
+                                  ray_index)
+    sweeps, first, counts = np.unique(sweep_index, return_index=True,
+                                      return_counts=True)
+    sub = copy.copy(radar)
+    for attr, value in vars(radar).items():
+        if attr in ['fields', 'range', 'sweep_start_ray_index',
+                    'sweep_end_ray_index']:
+            continue
+        if type(value) is dict:
+            if 'data' in value:
+                value = _subset_metadata(value, radar, rays, sweeps)
+            elif attr in ['instrument_parameters', 'radar_calibration']:
+                value = dict([(key, _subset_metadata(val, radar, rays, sweeps))
+                              for key, val in value.items()])
+            setattr(sub, attr, value)
+    sub.fields = {}
+    for name in (radar.fields if fields is None else fields):
+        field_dict = dict(radar.fields[name])
+        field_dict['data'] = field_dict['data'][rays, gates]
+        sub.fields[name] = field_dict
+    sub.range = dict(radar.range)
+    sub.range['data'] = radar.range['data'][gates]
+    sub.sweep_start_ray_index = dict(radar.sweep_start_ray_index)
+    sub.sweep_start_ray_index['data'] = first.astype('int32')
+    sub.sweep_end_ray_index = dict(radar.sweep_end_ray_index)
+    sub.sweep_end_ray_index['data'] = (first + counts - 1).astype('int32')
+    sub.nrays = len(ray_index)
+    sub.ngates = len(sub.range['data'])
+    sub.nsweeps = len(sweeps)
+    return sub
+
+
+def _subset_metadata(meta, radar, rays, sweeps):
+    """Subsets a per-ray or per-sweep metadata dictionary."""
+    if type(meta) is not dict or 'data' not in meta:
+        return meta
+    data = meta['data']
+    if np.ndim(data) == 0:
+        return meta
+    meta = dict(meta)
+    if len(data) == radar.nrays:
+        meta['data'] = data[rays]
+    elif len(data) == radar.nsweeps:
+        meta['data'] = data[sweeps]
+    return meta
+
+
+def get_z_from_radar(radar):
+    """Input radar object, return z from radar (km, 2D)"""
+    return get_gate_xyz(radar)[2] + radar.altitude['data']
+
+
+def get_gate_xyz(radar):
+    """Input radar object, return gate x, y, z relative to radar (m, 2D)"""
+    azimuth_1D = radar.azimuth['data']
+    elevation_1D = radar.elevation['data']
+    srange_1D = radar.range['data']
+    sr_2d, az_2d = np.meshgrid(srange_1D, azimuth_1D)
+    el_2d = np.meshgrid(srange_1D, elevation_1D)[1]
+    try:
+        from pyart.io.common import radar_coords_to_cart
+    except ImportError:  # Renamed in later Py-ART versions
+        from pyart.core import antenna_to_cartesian as radar_coords_to_cart
+    return radar_coords_to_cart(sr_2d/RNG_MULT, az_2d, el_2d)
+
+
+def filter_monotonic_sounding(snd_z, snd_T):
+    """
+    So sounding interpolation doesn't fail, keep only the levels that are
+    higher than the level before them and have valid (unmasked) height and
+    temperature. This eliminates data from descending balloons. Returns
+    plain arrays of the heights and temperatures kept.
+    """
+    snd_z = np.ma.asanyarray(snd_z)
+    snd_T = np.ma.asanyarray(snd_T)
+    keep = np.ones(np.shape(snd_z), dtype=bool)
+    keep[1:] = np.ma.filled(snd_z[1:] > snd_z[:-1], False)
+    keep &= ~np.ma.getmaskarray(snd_z)
+    keep &= ~np.ma.getmaskarray(snd_T)
+    return np.ma.getdata(snd_z)[keep], np.ma.getdata(snd_T)[keep]
+
+
+def read_sounding(filename, time=None):
+    """
+    Reads a skewt (i.e., UWYO) formatted sounding file and returns a
+    Sounding object. Parsed files are cached by name and modification time,
+    so many volumes sharing one sounding only read it once per process.
+
+    Arguments
+    ---------
+    filename = Name of sounding file
+
+    Keywords
+    --------
+    time = Valid time (datetime) of the sounding, used for interpolating
+           between soundings
+    """
+    key = (os.path.abspath(filename), os.path.getmtime(filename))
+    with _SOUNDING_LOCK:
+        data = _SOUNDING_CACHE.pop(key, None)
+    if data is None:
+        snd = SkewT.Sounding(filename)
+        # Test for new version of skewt package
+        if hasattr(snd, 'soundingdata'):
+            data = filter_monotonic_sounding(snd.soundingdata['hght'],
+                                             snd.soundingdata['temp'])
+        else:
+            data = filter_monotonic_sounding(snd.data['hght'],
+                                             snd.data['temp'])
+    with _SOUNDING_LOCK:
+        _SOUNDING_CACHE[key] = data
+        while len(_SOUNDING_CACHE) > SOUNDING_CACHE_SIZE:
+            _SOUNDING_CACHE.popitem(last=False)
+    return Sounding(data[0], data[1], time=time)
+
+
+def interpolate_soundings(before, after, time):
+    """
+    Linearly interpolates two Sounding objects (with times set) to a time
+    between them, on the union of their height levels. Returns a Sounding.
+    """
+    span = _total_seconds(after.time - before.time)
+    weight = 0.0 if span == 0 else _total_seconds(time - before.time) / span
+    if weight < 0 or weight > 1:
+        warnings.warn('Scan time is not between the sounding times')
+    z = np.union1d(before.z, after.z)
+    T = (1.0 - weight) * np.interp(z, before.z, before.T) + \
+        weight * np.interp(z, after.z, after.T)
+    return Sounding(z, T, time=time)
+
+
+def get_radar_time(radar):
+    """Returns the start time of a Py-ART radar volume as a datetime."""
+    if hasattr(pyart.util, 'datetime_from_radar'):
+        return pyart.util.datetime_from_radar(radar)
+    from netCDF4 import num2date
+    return num2date(radar.time['data'][0], radar.time['units'])
+
+
+def _peak_rss():
+    """Returns the peak resident set size of this process in bytes."""
+    if resource is None:
+        return None
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+if hasattr(time, 'process_time'):
+    _cpu_time = time.process_time
+else:
+    _cpu_time = time.clock
+# CPU time of the calling thread only, where available (Python 3.7+)
+_thread_cpu_time = getattr(time, 'thread_time', _cpu_time)
+
+
+def _total_seconds(delta):
+    return delta.days * 86400.0 + delta.seconds + delta.microseconds / 1e6
+
+
+def _epoch_seconds(time):
+    """Returns a datetime (or netCDF4/cftime datetime) as s since 1970."""
+    time = datetime.datetime(time.year, time.month, time.day, time.hour,
+                             time.minute, time.second,
+                             getattr(time, 'microsecond', 0))
+    return _total_seconds(time - EPOCH)
+
+
+def _from_epoch_seconds(seconds):
+    return EPOCH + datetime.timedelta(seconds=float(seconds))
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+# os.replace overwrites existing files on Windows too (Python 3.3+)
+_replace = getattr(os, 'replace', os.rename)
+
+
+def hid_argmax(scores, confidence=False, ndim=None):
+    """
+    Returns the hydrometeor ID (1-based index of the top class) from an
+    (n_classes, ...) array of HID scores, keeping a running maximum over
+    the classes rather than sorting them, so only a few arrays the size of
+    one class are needed. Ties go to the first class, as with np.argmax.
+    With confidence=True, also returns the margin between the top two
+    scores, in percent of the top score scale (0-100, uint8). If ndim (that
+    of the radar data) is given, raises ValueError unless scores has one
+    more dimension.
+    """
+    if ndim is not None and np.ndim(scores) != ndim + 1:
+        raise ValueError('Expected HID scores with %d dimensions, got %d'
+                         % (ndim + 1, np.ndim(scores)))
+    best = np.array(scores[0], dtype='float64')
+    fh = np.ones(best.shape, dtype=np.intp)
+    if confidence:
+        second = np.full(best.shape, -np.inf)
+    for i in range(1, len(scores)):
+        score = scores[i]
+        better = score > best
+        fh[better] = i + 1
+        if confidence:
+            # Old best becomes second where beaten, else score may be
+            np.maximum(second, np.where(better, best, score), out=second)
+        np.maximum(best, score, out=best)
+    if not confidence:
+        return fh, None
+    margin = np.nan_to_num(100.0 * (best - second))
+    return fh, np.clip(np.round(margin), 0, 100).astype(np.uint8)
+
+
+def _accepts_keyword(function, name):
+    """Returns True if function takes a keyword argument of this name."""
+    try:
+        parameters = inspect.signature(function).parameters
+    except AttributeError:  # Python 2
+        return name in inspect.getargspec(function).args
+    return name in parameters
+
+
+def interpolate_sounding_to_gates(radar_z, snd_z, snd_T):
+    """Interpolates sounding temperature to gate heights (same shape)."""
+    rad_T1d = np.interp(radar_z.ravel(), snd_z, snd_T)
+    return np.reshape(rad_T1d, np.shape(radar_z))
+
+
+def _atomic_save(path, array, compress=False):
+    """
+    Saves an array to a .npy file (or a dict of arrays to a .npz file,
+    optionally compressed) via a temporary file and rename, so that
+    concurrent readers never see a partially written file.
+    """
+    tmp = '%s.%d.%d.tmp%s' % (path[:-4], os.getpid(),
+                              threading.current_thread().ident, path[-4:])
+    if isinstance(array, dict) and compress:
+        np.savez_compressed(tmp, **array)
+    elif isinstance(array, dict):
+        np.savez(tmp, **array)
+    else:
+        np.save(tmp, array)
+    try:
+        _replace(tmp, path)
+    except OSError:
+        # Windows will not rename over an existing file
+        os.remove(tmp)
+
+
+def _update_hash(hsh, value):
+    """
+    Adds a (nested) keyword value to a hashlib object by content: arrays by
+    dtype, shape, data, and mask, sounding files by their bytes, Sounding
+    objects by their heights, temperatures, and time.
+    """
+    if isinstance(value, np.ndarray):
+        data = np.ascontiguousarray(np.ma.getdata(value))
+        hsh.update(repr((data.dtype.str, data.shape)).encode('ascii'))
+        hsh.update(data.tobytes())
+        if np.ma.getmask(value) is not np.ma.nomask:
+            hsh.update(np.ascontiguousarray(np.ma.getmaskarray(
+                value)).tobytes())
+    elif isinstance(value, dict):
+        hsh.update(b'{')
+        for key in sorted(value, key=str):
+            _update_hash(hsh, key)
+            _update_hash(hsh, value[key])
+        hsh.update(b'}')
+    elif isinstance(value, (list, tuple)):
+        hsh.update(b'[')
+        for item in value:
+            _update_hash(hsh, item)
+        hsh.update(b']')
+    elif isinstance(value, Sounding):
+        _update_hash(hsh, ['Sounding', value.z, value.T, str(value.time)])
+    elif isinstance(value, str) and os.path.isfile(value):
+        with open(value, 'rb') as f:
+            hsh.update(f.read())
+    else:
+        hsh.update(repr(value).encode('utf-8'))
+
+
+def _json_default(value):
+    """Converts numpy scalars and arrays for json.dumps()."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(repr(value) + ' is not JSON serializable')
+
+
+def validate_kwargs(kwargs):
+    """
+    Checks a complete set of DualPolRetrieval keywords for invalid values,
+    raising ValueError listing every problem found.
+    """
+    problems = []
+    choices = {'fhc_method': ['hybrid', 'linear'], 'band': ['S', 'C', 'X'],
+               'sweep_pool': ['thread', 'process'],
+               'kdp_pool': ['thread', 'process'],
+               'subset_output': ['full', 'trim']}
+    for key in sorted(choices):
+        if kwargs[key] not in choices[key]:
+            problems.append('%s must be one of %s, not %r' %
+                            (key, choices[key], kwargs[key]))
+    # Looked up case-insensitively, as in calculate_kdp()
+    if str(kwargs['kdp_method']).upper() not in KDP_BACKENDS:
+        problems.append('kdp_method must be one of %s, not %r' %
+                        (sorted(KDP_BACKENDS), kwargs['kdp_method']))
+    if not isinstance(kwargs['output_precision'], dict) and \
+       kwargs['output_precision'] not in ['native', 'compact', 'packed']:
+        problems.append("output_precision must be 'native', 'compact', "
+                        "'packed', or a dict, not %r" %
+                        (kwargs['output_precision'],))
+    for key in ['sweep_workers', 'block_size', 'kdp_workers',
+                'kdp_chunk_size', 'fused_block_size', 'fhc_block_size']:
+        value = kwargs[key]
+        if value is not None and (not isinstance(value, numbers.Real) or
+                                  not value > 0):
+            problems.append('%s must be positive or None' % key)
+    unknown = sorted(set(kwargs['fhc_weights']) - set(DEFAULT_WEIGHTS))
+    if unknown:
+        problems.append('Unknown fhc_weights variable(s): ' +
+                        ', '.join(unknown))
+    for key in ['dz', 'dr', 'rh', 'name_fhc', 'name_sdp']:
+        if not isinstance(kwargs[key], str):
+            problems.append('%s must be a field name' % key)
+    if problems:
+        raise ValueError('; '.join(problems))
+
+
+def resolve_kwarg_objects(kwargs):
+    """
+    Returns a copy of a complete set of DualPolRetrieval keywords with the
+    shorthands for geometry_cache, instrument, kdp_cache, result_cache, and
+    buffer_pool (True, a callback, or a directory name) replaced by the
+    objects they stand for.
+    """
+    kwargs = dict(kwargs)
+    if kwargs['geometry_cache'] is True:
+        kwargs['geometry_cache'] = GEOMETRY_CACHE
+    if kwargs['instrument'] is True:
+        kwargs['instrument'] = Instrumentation()
+    elif kwargs['instrument'] is not None and \
+            not isinstance(kwargs['instrument'], Instrumentation):
+        kwargs['instrument'] = Instrumentation(
+            callbacks=[kwargs['instrument']])
+    if isinstance(kwargs['kdp_cache'], str):
+        kwargs['kdp_cache'] = KdpCache(kwargs['kdp_cache'])
+    if isinstance(kwargs['result_cache'], str):
+        kwargs['result_cache'] = ResultCache(kwargs['result_cache'])
+    if kwargs['buffer_pool'] is True:
+        kwargs['buffer_pool'] = BUFFER_POOL
+    return kwargs
+
+
+def plan_stages(kwargs):
+    """
+    Returns the retrieval stages DualPolRetrieval runs up front, in order,
+    for a complete set of keywords (stages they depend on run as needed).
+    """
+    return ['kdp', 'sounding'] + [stage for stage in STAGE_ORDER
+                                  if stage in STAGE_FLAGS and
+                                  kwargs[STAGE_FLAGS[stage]]]
+
+
+def output_dtype(product, policy):
+    """
+    Returns the dtype a product (e.g., 'FH', 'KDP', 'rain') is stored as
+    under an output_precision policy, or None if it is kept as computed.
+    """
+    if product == 'FH_CONF':
+        return 'uint8'  # Always compact
+    if isinstance(policy, dict):
+        return policy.get(product)
+    if policy in ['compact', 'packed']:
+        if product in CATEGORICAL_PRODUCTS:
+            return 'uint8'
+        return 'float32'
+    return None
+
+
+def _kwargs_hash(kwargs, ignored=()):
+    """Returns a content hash of keywords, leaving out those in ignored."""
+    hsh = hashlib.sha1()
+    _update_hash(hsh, dict([(key, kwargs[key]) for key in kwargs
+                            if key not in ignored]))
+    return hsh.hexdigest()
+
+
+def _same_value(a, b):
+    """Compares keyword values, including arrays, by content."""
+    try:
+        return bool(a == b)
+    except ValueError:  # Arrays
+        return False
+
+
+def check_kwargs(kwargs, default_kw):
+    """
+    Check user-provided kwargs against defaults, and if some defaults aren't
+    provided by user make sure they are provided to the function regardless.
+    """
+    for key in default_kw:
+        if key not in kwargs:
+            kwargs[key] = default_kw[key]
+    return kwargs
+
+#####################################
+
+
+def expand_file_list(files):
+    """
+    Generator that turns a file name, glob pattern, or iterable of file
+    names/glob patterns into a stream of file names. Glob matches are sorted
+    so that processing order is deterministic.
+    """
+    if isinstance(files, str):
+        files = [files]
+    for entry in files:
+        if isinstance(entry, str) and any(c in entry for c in '*?['):
+            for filename in sorted(glob.glob(entry)):
+                yield filename
+        else:
+            yield entry
+
+
+BatchResult = namedtuple('BatchResult', ['index', 'filename', 'success',
+                                         'output', 'error', 'elapsed'])
+
+
+def batch_retrieval(files, kwargs=None, nproc=1, max_pending=None,
+                    output_dir=None, output_suffix='_dualpol.nc',
+                    writer=None):
+    """
+    Runs DualPolRetrieval over many radar files, optionally spreading the
+    volumes across a pool of processes. This is a generator that yields one
+    BatchResult per file, always in the same order as the input files. A
+    failed volume is reported in its BatchResult and does not stop the run.
+
+    Arguments
+    ---------
+    files = File name, glob pattern, or iterable of file names/glob patterns
+
+    Keywords
+    --------
+    kwargs = Dictionary of DualPolRetrieval keywords shared by every volume
+    nproc = Number of worker processes. 1 processes everything in this process.
+    max_pending = Maximum number of volumes submitted to the pool but not yet
+                  yielded. Input file names are consumed lazily, so memory
+                  use stays flat regardless of archive size.
+                  Default is 2 * nproc.
+    output_dir = If provided, each retrieval is written to this directory as
+                 a CF/Radial file named after the input file plus
+                 output_suffix. It is created if needed.
+    output_suffix = Suffix appended to the input file's base name for output.
+    writer = Optional function called as writer(retrieve, filename) in the
+             worker after a successful retrieval, instead of the default
+             CF/Radial output. Its return value is reported as
+             BatchResult.output. Must be a module-level function if nproc > 1.
+             With a buffer_pool in kwargs, the default output releases each
+             retrieval after writing it; a writer may call
+             retrieve.release() itself.
+
+    Returns
+    -------
+    Generator of BatchResult named tuples with fields index, filename,
+    success, output, error (None or a text description), elapsed (seconds).
+    """
+    if kwargs is None:
+        kwargs = {}
+    if max_pending is None:
+        max_pending = 2 * nproc
+    max_pending = max(1, max_pending)
+    if output_dir is not None and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    args = (kwargs, output_dir, output_suffix, writer)
+    if nproc <= 1:
+        for index, filename in enumerate(expand_file_list(files)):
+            yield _batch_worker(index, filename, *args)
+        return
+    pool = multiprocessing.Pool(nproc)
+    pending = deque()
+    try:
+        for index, filename in enumerate(expand_file_list(files)):
+            pending.append((index, filename, pool.apply_async(
+                _batch_worker, (index, filename) + args)))
+            if len(pending) >= max_pending:
+                yield _collect_batch_result(*pending.popleft())
+        while pending:
+            yield _collect_batch_result(*pending.popleft())
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def _collect_batch_result(index, filename, async_result):
+    """Waits on a pool task, turning pool-level errors into a BatchResult."""
+    try:
+        return async_result.get()
+    except Exception as err:
+        return BatchResult(index, filename, False, None, repr(err), None)
+
+
+def _batch_worker(index, filename, kwargs, output_dir, output_suffix,
+                  writer):
+    """Retrieves and saves a single volume for batch_retrieval()."""
+    start = time.time()
+    try:
+        retrieve = DualPolRetrieval(filename, **dict(kwargs))
+        if not retrieve.success:
+            error = '; '.join(retrieve.errors)
+            return BatchResult(index, filename, False, None,
+                               error or 'Retrieval failed',
+                               time.time() - start)
+        output = None
+        if writer is not None:
+            output = writer(retrieve, filename)
+        elif output_dir is not None:
+            base = os.path.splitext(os.path.basename(str(filename)))[0]
+            output = os.path.join(output_dir, base + output_suffix)
+            pyart.io.write_cfradial(output, retrieve.radar)
+            retrieve.release()
+    except Exception:
+        return BatchResult(index, filename, False, None,
+                           traceback.format_exc(), time.time() - start)
+    return BatchResult(index, filename, True, output, None,
+                       time.time() - start)
+
+
+ServiceResult = namedtuple('ServiceResult', ['filename', 'success', 'output',
+                                             'error', 'arrival', 'latency',
+                                             'wait', 'elapsed'])
+
+
+class WatchService(object):
+
+    """
+    Long-running service that retrieves new radar files as they are dropped
+    into a directory. A file is picked up once its size and modification
+    time have not changed for settle_time seconds. Volumes are retrieved in a
+    bounded pool of workers (like batch_retrieval) that lives as long as the
+    service, so each worker's GeometryCache and parsed sounding files stay
+    warm between volumes. A sounding file named in kwargs is also parsed once
+    here and passed to workers as a Sounding object (reread if it changes).
+
+    Each finished volume is passed to publish(result) as a ServiceResult,
+    with its file's modification time (arrival, s since 1970), end-to-end
+    latency from arrival to publishing, time spent waiting for a worker,
+    and retrieval time (all in seconds). Skipped volumes are published with
+    success False and error 'skipped: ...'.
+
+    Backpressure
+    ------------
+    policy = 'queue' retrieves every volume in arrival order, however far
+             behind that gets. 'skip' keeps at most max_queue volumes
+             waiting, skipping the oldest, so the service stays current
+             under bursty arrival.
+    max_age = Volumes that have waited longer than this (s, since arrival)
+              are skipped instead of retrieved, under either policy.
+
+    Sample interface
+    ----------------
+    service = dualpol.WatchService('/incoming', kwargs={'dp': 'DP'},
+                                   workers=2, policy='skip', max_queue=2,
+                                   output_dir='products', publish=print)
+    service.run()  # Until stop() is called from another thread, or Ctrl-C
+    print(service.latency_stats())
+    """
+
+    def __init__(self, watch_dir, kwargs=None, pattern='*', workers=1,
+                 pool='process', policy='queue', max_queue=1, max_age=None,
+                 poll_interval=1.0, settle_time=1.0, output_dir=None,
+                 output_suffix='_dualpol.nc', writer=None, publish=None,
+                 process_existing=False):
+        if policy not in ['queue', 'skip']:
+            raise ValueError("policy must be 'queue' or 'skip'")
+        self.watch_dir = watch_dir
+        self.kwargs = dict(kwargs) if kwargs is not None else {}
+        if 'plan' not in self.kwargs:
+            self.kwargs.setdefault('geometry_cache', True)
+        self.pattern = pattern
+        self.workers = max(1, int(workers))
+        self.pool_type = pool
+        self.policy = policy
+        self.max_queue = max(1, int(max_queue))
+        self.max_age = max_age
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.output_args = (output_dir, output_suffix, writer)
+        if output_dir is not None and not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        self.publish = publish
+        self.pending = deque()
+        self.running = []
+        self.stats = {'processed': 0, 'failed': 0, 'skipped': 0}
+        self.latencies = deque(maxlen=1000)
+        self._candidates = {}
+        self._done = set()
+        self._stop = threading.Event()
+        if not process_existing:
+            self._done.update(self.listing())
+
+    def listing(self):
+        """Returns the files in the watched directory matching pattern."""
+        return [path for path in glob.glob(os.path.join(self.watch_dir,
+                                                        self.pattern))
+                if os.path.isfile(path)]
+
+    def scan(self):
+        """Queues files that have arrived and finished being written."""
+        now = time.time()
+        listing = self.listing()
+        # Forget files that are gone, so memory doesn't grow over time
+        self._done.intersection_update(listing)
+        new = []
+        for path in listing:
+            if path in self._done:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            signature = (stat.st_size, stat.st_mtime)
+            previous = self._candidates.get(path)
+            if previous is None or previous[0] != signature:
+                self._candidates[path] = (signature, now)
+                if self.settle_time > 0:
+                    continue
+            elif now - previous[1] < self.settle_time:
+                continue
+            del self._candidates[path]
+            self._done.add(path)
+            new.append((stat.st_mtime, path))
+        for arrival, path in sorted(new):
+            self.pending.append((path, arrival))
+        if self.policy == 'skip':
+            # Volumes about to go to free workers don't count as queued
+            free = max(0, self.workers - len(self.running))
+            while len(self.pending) > self.max_queue + free:
+                self.skip(self.pending.popleft(), 'newer volumes waiting')
+
+    def dispatch(self, pool):
+        """Hands waiting volumes to free workers."""
+        while self.pending and len(self.running) < self.workers:
+            path, arrival = self.pending.popleft()
+            now = time.time()
+            if self.max_age is not None and now - arrival > self.max_age:
+                self.skip((path, arrival), 'older than max_age')
+                continue
+            kwargs = self.kwargs
+            if isinstance(kwargs.get('sounding'), str):
+                kwargs = dict(kwargs, sounding=read_sounding(
+                    kwargs['sounding']))
+            task = pool.apply_async(_batch_worker, (
+                0, path, kwargs) + self.output_args)
+            self.running.append((path, arrival, now, task))
+
+    def collect(self):
+        """Publishes the results of finished volumes."""
+        for item in [item for item in self.running if item[3].ready()]:
+            self.running.remove(item)
+            path, arrival, started, task = item
+            result = _collect_batch_result(0, path, task)
+            finished = time.time()
+            self.stats['processed' if result.success else 'failed'] += 1
+            self.latencies.append(finished - arrival)
+            self._publish(ServiceResult(
+                path, result.success, result.output, result.error, arrival,
+                finished - arrival, started - arrival, result.elapsed))
+
+    def skip(self, item, reason):
+        path, arrival = item
+        self.stats['skipped'] += 1
+        self._publish(ServiceResult(path, False, None, 'skipped: ' + reason,
+                                    arrival, time.time() - arrival, None,
+                                    None))
+
+    def _publish(self, result):
+        if self.publish is not None:
+            self.publish(result)
+
+    def run(self, max_volumes=None, timeout=None):
+        """
+        Watches and retrieves until stop() is called, or until max_volumes
+        volumes have been published or timeout seconds have passed (if
+        set). Volumes still being retrieved are finished before returning.
+        """
+        self._stop.clear()
+        if self.pool_type == 'process':
+            pool = multiprocessing.Pool(self.workers)
+        else:
+            pool = ThreadPool(self.workers)
+        start = time.time()
+        try:
+            while not self._stop.is_set():
+                self.scan()
+                self.dispatch(pool)
+                self.collect()
+                if max_volumes is not None and \
+                   sum(self.stats.values()) >= max_volumes:
+                    break
+                if timeout is not None and time.time() - start > timeout:
+                    break
+                self._stop.wait(self.poll_interval)
+            while self.running:
+                time.sleep(0.01)
+                self.collect()
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+    def stop(self):
+        """Asks run() to return (safe to call from another thread)."""
+        self._stop.set()
+
+    def latency_stats(self):
+        """
+        Returns a dict of volume counts and mean, median, 95th percentile,
+        and maximum end-to-end latency (s) over the last 1000 volumes.
+        """
+        stats = dict(self.stats)
+        if self.latencies:
+            lat = np.array(self.latencies)
+            stats.update({'mean': float(lat.mean()),
+                          'median': float(np.median(lat)),
+                          'p95': float(np.percentile(lat, 95)),
+                          'max': float(lat.max())})
+        return stats
+
+
+NetworkResult = namedtuple('NetworkResult', ['site', 'volume', 'success',
+                                             'error', 'tiles', 'wait',
+                                             'elapsed'])
+
+
+class RadarNetwork(object):
+
+    """
+    Retrieves volumes from a network of radars in one shared pool of
+    workers and merges their products (fields, default rain and FH) into a
+    Mosaic on a common grid (grid_shape and grid_limits in m from origin, as
+    in GridMapper).
+
+    Each site keeps its own state for the life of the network: a
+    GeometryCache and a GridMapper (under cache_dir/<site> if cache_dir is
+    given, and reused by every worker), its DualPolRetrieval keywords (e.g.,
+    its sounding file, parsed once here and shared with workers as a
+    Sounding object), a priority, and a queue of waiting volumes.
+
+    Volumes are handed to free workers by stride scheduling: the next volume
+    comes from the waiting site that has had the least service relative to
+    its priority, so a site sending many volumes gets no more than its
+    share and cannot starve the others. With max_queue, each site keeps at
+    most that many volumes waiting, skipping its oldest.
+
+    Each finished volume updates only the mosaic tiles its site covers, and
+    is passed to publish(result) as a NetworkResult with the site, volume,
+    success, error, the tiles merged (None if a later volume from the site
+    was merged first), time spent waiting for a worker, and retrieval time
+    (s).
+
+    Sample interface
+    ----------------
+    network = dualpol.RadarNetwork(
+        (1, 501, 501), ((1000, 1000), (-250000, 250000), (-250000, 250000)),
+        origin=(35.2, -97.4), kwargs={'dp': 'DP'}, workers=4,
+        sites={'KTLX': {'kwargs': {'sounding': 'OUN.txt'}, 'priority': 2},
+               'KINX': {'kwargs': {'sounding': 'OUN.txt'}}})
+    network.run([('KTLX', 'KTLX_0000.nc'), ('KINX', 'KINX_0001.nc')])
+    rain = network.mosaic.grids['rain']
+    """
+
+    def __init__(self, grid_shape, grid_limits, origin, sites=None,
+                 kwargs=None, fields=None, roi=1000.0,
+                 tile_shape=(64, 64), workers=1, pool='process',
+                 max_queue=None, cache_dir=None, publish=None):
+        self.grid_shape = tuple(grid_shape)
+        self.grid_limits = grid_limits
+        self.origin = origin
+        self.roi = roi
+        self.kwargs = dict(kwargs) if kwargs is not None else {}
+        self.fields = list(fields) if fields is not None else ['rain', 'FH']
+        self.mosaic = Mosaic(grid_shape, tile_shape=tile_shape)
+        self.workers = max(1, int(workers))
+        self.pool_type = pool
+        self.max_queue = max_queue
+        self.cache_dir = cache_dir
+        self.publish = publish
+        self.sites = OrderedDict()
+        self.running = []
+        self.stats = {'processed': 0, 'failed': 0, 'skipped': 0}
+        self._token = '%x_%x' % (id(self), int(time.time() * 1e6))
+        self._pass = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        if sites is not None:
+            for site in sites:
+                self.add_site(site, **sites[site])
+
+    def add_site(self, site, kwargs=None, priority=1.0):
+        """
+        Registers a site. kwargs are DualPolRetrieval keywords for this site
+        only, added to the network's. A site with priority 2 gets twice the
+        share of workers of a site with priority 1 when both have volumes
+        waiting.
+        """
+        cache_dir = None
+        if self.cache_dir is not None:
+            cache_dir = os.path.join(self.cache_dir, str(site))
+        geometry_cache = GeometryCache(cache_dir=cache_dir)
+        kw = dict(self.kwargs)
+        kw.update(kwargs or {})
+        kw['geometry_cache'] = geometry_cache
+        self.sites[site] = {
+            'kwargs': kw, 'priority': float(priority), 'queue': deque(),
+            'pass': self._pass, 'geometry_cache': geometry_cache,
+            'dispatched': 0, 'merged': 0,
+            'mapper': GridMapper(self.grid_shape, self.grid_limits,
+                                 roi=self.roi, maxsize=2, cache_dir=cache_dir,
+                                 geometry_cache=geometry_cache,
+                                 origin=self.origin)}
+
+    def submit(self, site, volume):
+        """
+        Queues a volume (file name or Py-ART radar object) from a site,
+        registering the site with default settings if it is new. Safe to
+        call from another thread while run() is going.
+        """
+        with self._lock:
+            if site not in self.sites:
+                self.add_site(site)
+            state = self.sites[site]
+            if not state['queue']:
+                # Idle sites don't bank service to spend later
+                state['pass'] = max(state['pass'], self._pass)
+            state['queue'].append((volume, time.time()))
+            skipped = []
+            while self.max_queue is not None and \
+                    len(state['queue']) > max(1, self.max_queue):
+                skipped.append(state['queue'].popleft())
+        for volume, arrival in skipped:
+            self.stats['skipped'] += 1
+            self._publish(NetworkResult(site, volume, False,
+                                        'skipped: newer volumes waiting',
+                                        None, time.time() - arrival, None))
+
+    def next_volume(self):
+        """
+        Removes and returns (site, volume, arrival) for the next volume to
+        retrieve, or None if nothing is waiting.
+        """
+        with self._lock:
+            waiting = [site for site in self.sites
+                       if self.sites[site]['queue']]
+            if not waiting:
+                return None
+            site = min(waiting, key=lambda s: (
+                self.sites[s]['pass'], self.sites[s]['queue'][0][1]))
+            state = self.sites[site]
+            self._pass = state['pass']
+            state['pass'] += 1.0 / state['priority']
+            volume, arrival = state['queue'].popleft()
+        return site, volume, arrival
+
+    def dispatch(self, pool):
+        """Hands waiting volumes to free workers."""
+        while len(self.running) < self.workers:
+            item = self.next_volume()
+            if item is None:
+                break
+            site, volume, arrival = item
+            state = self.sites[site]
+            kwargs = state['kwargs']
+            if isinstance(kwargs.get('sounding'), str):
+                kwargs = dict(kwargs, sounding=read_sounding(
+                    kwargs['sounding']))
+            task = pool.apply_async(_network_worker, (
+                self._token, site, volume, kwargs, state['mapper'],
+                self.fields))
+            state['dispatched'] += 1
+            self.running.append((site, volume, arrival, time.time(), task,
+                                 state['dispatched']))
+
+    def collect(self):
+        """Merges the results of finished volumes into the mosaic."""
+        for item in [item for item in self.running if item[4].ready()]:
+            self.running.remove(item)
+            site, volume, arrival, started, task, number = item
+            try:
+                success, output, error, elapsed = task.get()
+            except Exception as err:
+                success, output, error, elapsed = False, None, repr(err), None
+            tiles = None
+            state = self.sites[site]
+            # A later volume from the site may have finished first
+            if success and number > state['merged']:
+                tiles = self.mosaic.update(site, *output)
+                state['merged'] = number
+            self.stats['processed' if success else 'failed'] += 1
+            self._publish(NetworkResult(site, volume, success, error, tiles,
+                                        started - arrival, elapsed))
+
+    def _publish(self, result):
+        if self.publish is not None:
+            self.publish(result)
+
+    def run(self, volumes=None, until_idle=True, poll_interval=0.01):
+        """
+        Submits (site, volume) pairs from volumes, if given, and retrieves
+        them. Returns when nothing is waiting or running, or, with
+        until_idle=False, when stop() is called (volumes can then keep
+        arriving through submit()). Volumes being retrieved are finished
+        before returning.
+        """
+        if volumes is not None:
+            for site, volume in volumes:
+                self.submit(site, volume)
+        self._stop.clear()
+        if self.pool_type == 'process':
+            pool = multiprocessing.Pool(self.workers)
+        else:
+            pool = ThreadPool(self.workers)
+        try:
+            while not self._stop.is_set():
+                self.dispatch(pool)
+                self.collect()
+                if until_idle and not self.running and \
+                   not any(state['queue'] for state in self.sites.values()):
+                    break
+                self._stop.wait(poll_interval)
+            while self.running:
+                time.sleep(poll_interval)
+                self.collect()
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+            # Thread workers share this process's caches; process workers'
+            # copies went away with the pool
+            for key in [key for key in list(_NETWORK_OBJECTS)
+                        if key[0] == self._token]:
+                del _NETWORK_OBJECTS[key]
+
+    def stop(self):
+        """Asks run() to return (safe to call from another thread)."""
+        self._stop.set()
+
+
+# Per-site caches in each worker, keyed by (network, site, kind). A
+# network's entries are removed when its run() returns.
+_NETWORK_OBJECTS = {}
+
+
+def _network_worker(token, site, volume, kwargs, mapper, fields):
+    """
+    Retrieves one volume for RadarNetwork. Returns the success flag, the
+    (cover, parts) mosaic contributions of the fields, an error description,
+    and elapsed time.
+    """
+    start = time.time()
+    # Pickled caches arrive empty in worker processes, so keep the first
+    # copy of each and reuse it for the site's later volumes
+    mapper = _NETWORK_OBJECTS.setdefault((token, site, 'mapper'), mapper)
+    if kwargs.get('geometry_cache') is not None:
+        kwargs = dict(kwargs, geometry_cache=_NETWORK_OBJECTS.setdefault(
+            (token, site, 'geometry'), kwargs['geometry_cache']))
+    try:
+        retrieve = DualPolRetrieval(volume, **dict(kwargs))
+        if not retrieve.success:
+            error = '; '.join(retrieve.errors)
+            return False, None, error or 'Retrieval failed', \
+                time.time() - start
+        output = mapper.contributions(
+            retrieve.radar, [name for name in fields
+                             if name in retrieve.radar.fields])
+        retrieve.release()
+    except Exception:
+        return False, None, traceback.format_exc(), time.time() - start
+    return True, output, None, time.time() - start
+
+
+def main(argv=None):
+    """
+    Command-line interface to batch_retrieval() and, with --watch,
+    WatchService. Run python dualpol.py -h for usage. Returns 0 if every
+    volume succeeded, 1 otherwise.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Run DualPol retrievals over many radar files.')
+    parser.add_argument('files', nargs='+',
+                        help='Radar files or (quoted) glob patterns, or '
+                             'the directory to watch with --watch')
+    parser.add_argument('-n', '--nproc', type=int, default=1,
+                        help='Number of worker processes')
+    parser.add_argument('-o', '--output-dir', default=None,
+                        help='Directory for CF/Radial output files')
+    parser.add_argument('-k', '--kwargs', default=None,
+                        help='DualPolRetrieval keywords as a JSON string '
+                             'or the name of a JSON file')
+    parser.add_argument('--max-pending', type=int, default=None,
+                        help='Maximum volumes in flight (default 2*nproc)')
+    parser.add_argument('--log', default=None,
+                        help='Write one JSON record per volume to this file')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep retrieving files as they arrive in the '
+                             'given directory, until interrupted')
+    parser.add_argument('--pattern', default='*',
+                        help='Glob pattern of files to pick up with --watch')
+    parser.add_argument('--policy', default='queue', choices=['queue', 'skip'],
+                        help='With --watch, retrieve every volume (queue) or '
+                             'skip the oldest waiting ones (skip)')
+    parser.add_argument('--max-queue', type=int, default=1,
+                        help='Volumes kept waiting with --policy skip')
+    parser.add_argument('--max-age', type=float, default=None,
+                        help='With --watch, skip volumes older than this (s)')
+    args = parser.parse_args(argv)
+    kw = {}
+    if args.kwargs is not None:
+        if os.path.isfile(args.kwargs):
+            with open(args.kwargs) as f:
+                kw = json.load(f)
+        else:
+            kw = json.loads(args.kwargs)
+    log = open(args.log, 'w') if args.log is not None else None
+    nfail = 0
+    if args.watch:
+        def publish(result):
+            if result.success:
+                print('OK', result.filename, '->', result.output,
+                      '(latency %.2f s)' % result.latency)
+            else:
+                print('FAIL', result.filename, ':', result.error)
+            if log is not None:
+                log.write(json.dumps(result._asdict()) + '\n')
+                log.flush()
+        service = WatchService(
+            args.files[0], kwargs=kw, pattern=args.pattern,
+            workers=args.nproc, policy=args.policy, max_queue=args.max_queue,
+            max_age=args.max_age, output_dir=args.output_dir,
+            publish=publish)
+        try:
+            service.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if log is not None:
+                log.close()
+        print(service.latency_stats())
+        return 0
+    try:
+        for result in batch_retrieval(
+                args.files, kwargs=kw, nproc=args.nproc,
+                max_pending=args.max_pending, output_dir=args.output_dir):
+            if result.success:
+                print('OK', result.filename, '->', result.output,
+                      '(%.2f s)' % result.elapsed)
+            else:
+                nfail += 1
+                print('FAIL', result.filename, ':', result.error)
+            if log is not None:
+                log.write(json.dumps(result._asdict()) + '\n')
+                log.flush()
+    finally:
+        if log is not None:
+            log.close()
+    return 1 if nfail else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())